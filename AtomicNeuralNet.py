@@ -1,42 +1,149 @@
 from chess.keras.NNet import NNetWrapper as nn
 from utils import *
 
+from collections import deque
 import multiprocessing as mp
+import os
+import threading
+import numpy as np
+import queue
 import random
+import time
 
 
 class NNetSync():
     """
     Convenience class for NNetWorker and AtomicNNet
     """
-    def __init__(self):
+    def __init__(self, responses, slots=None):
         self.work_queue = mp.Queue()
-        self.done_queue = mp.Queue()
-        self.done_lock = mp.Lock()
+        self.responses = responses      # send ends of the response channels, see NNetManager
+        self.slots = slots              # PredictSlots of the response channels, or None
+        self.inflight = mp.Value('i', 0)    # stores boards put on work_queue and not answered yet
 
 
-def NNetWorker(game, nsync, i): 
+def NNetWorker(game, nsync, i, max_batch=1, batch_timeout=0.002, make_nnet=nn, double_buffer=True):
     """
     Workaround for multiprocessing errors when using Queue. Have to
     have queue passed from parent to child process in order for everything
     to work. Also there can only be one NNet, so multiple mcts_worker 
     threads share this NNet.
+
+    Predict requests are micro-batched: after a predict (or predict_batch)
+    the worker keeps taking predict requests off its queue until it has
+    max_batch boards or batch_timeout seconds went by, evaluates all of
+    them in one forward pass and routes each result back. A request that
+    would take the batch past max_batch, or any other instruction, is
+    handled once that batch is done.
+
+    Every answered request takes its load off nsync.inflight, which
+    NNetManager.schedule() uses to pick the least loaded worker.
+
+    A predict request marked "shared" carries no boards: they are in the
+    PredictSlots of its response channel, and the policies and values are
+    written back there instead of being sent.
+
+    With double_buffer the worker holds a standby NNet next to the one
+    answering predicts. A swap request loads its checkpoint into the
+    standby NNet in a background thread while predicts keep being served,
+    and the two are exchanged between two batches once it is loaded. Every
+    result is sent with the version of the model that computed it.
     """
 
     print("[NNet Worker " + str(i) + "] Started!")
 
-    nnet = nn(game)
+    nnet = make_nnet(game)
+    standby = make_nnet(game) if double_buffer else None   # built before any weights are loaded
+
+    version = 0             # stores version of the model in nnet
+    swaps = []              # stores swap requests, the first one is loading into standby
+    loaded = threading.Event()
 
-    lock = nsync.done_lock
     work_queue = nsync.work_queue
-    done_queue = nsync.done_queue
+    responses = nsync.responses
+    slots = nsync.slots
+
+    stats = BatchStats()
+    waiting = []    # stores instructions received while collecting a batch
 
     while True:
-        data_id, data = work_queue.get()
+        if swaps and loaded.is_set():
+            # Between two batches, so every batch is evaluated by one model
+            data_id, channel, data = swaps.pop(0)
+            loaded.clear()
+            if not data.get("failed"):
+                nnet, standby = standby, nnet
+                version = data["version"]
+                print("[NNet Worker " + str(i) + "] Swapped in model version " + str(version))
+            responses[channel].send((data_id, version, "OK"))
+            done(nsync, data)
+            if swaps:
+                start_load(standby, swaps[0][2], loaded)
+            continue
+
+        if waiting:
+            data_id, channel, data = waiting.pop(0)
+        else:
+            try:
+                # Poll while a model is loading, to swap it in right away
+                data_id, channel, data = work_queue.get(timeout=0.01 if swaps else None)
+            except queue.Empty:
+                continue
         #print("[NNet Worker " + str(i) + "] Got Work!")
 
-        if data["inst"] == "predict":
-            res = nnet.predict(data["board"])
+        if data["inst"] in ("predict", "predict_batch"):
+            batch = [(data_id, channel, data)]
+            size = request_size(data)
+            deadline = time.time() + batch_timeout
+            while size < max_batch and not waiting:
+                try:
+                    data_id, channel, data = work_queue.get(timeout=max(deadline - time.time(), 0))
+                except queue.Empty:
+                    break
+                if data["inst"] in ("predict", "predict_batch") and size + request_size(data) <= max_batch:
+                    batch.append((data_id, channel, data))
+                    size += request_size(data)
+                else:
+                    waiting.append((data_id, channel, data))    # starts the next batch
+
+            boards = np.concatenate([request_boards(slots, channel, data) for _, channel, data in batch])
+            start = time.time()
+            pis, vs = nnet.predict_batch(boards)
+            stats.busy += time.time() - start
+
+            offset = 0
+            now = time.time()
+            for data_id, channel, data in batch:
+                n = request_size(data)
+                if "shared" in data:
+                    slots.pis[channel, :n] = pis[offset:offset+n]
+                    slots.vs[channel, :n] = np.reshape(vs[offset:offset+n], n)
+                    res = None
+                elif data["inst"] == "predict_batch":
+                    res = (pis[offset:offset+n], vs[offset:offset+n])
+                else:
+                    res = (pis[offset], vs[offset])
+                offset += n
+                responses[channel].send((data_id, version, res))
+                stats.request(now - data["sent"])
+                done(nsync, data)
+            stats.batch(len(boards))
+            continue
+
+        elif data["inst"] == "stats":
+            res = stats.summary()
+            res["version"] = version
+
+        elif data["inst"] == "swap":
+            if standby is not None:
+                swaps.append((data_id, channel, data))
+                if len(swaps) == 1:
+                    start_load(standby, data, loaded)
+                continue
+            print("[NNetWorker] Got swap...")
+            nnet.load_checkpoint(folder=data["folder"], filename=data["filename"])
+            version = data["version"]
+            res = "OK"
 
         elif data["inst"] == "save":
             print("[NNetWorker] Got save...")
@@ -54,41 +161,224 @@ def NNetWorker(game, nsync, i):
             res = "OK"
 
         #print("[NNet Worker " + str(i) + "] Done!")
-        done_queue.put((data_id, res))
+        responses[channel].send((data_id, version, res))
+        done(nsync, data)
+
+
+def start_load(model, data, loaded):
+    """
+    Loads the checkpoint of swap request data into model in a background
+    thread and sets loaded once it is done. A checkpoint that fails to load
+    marks data as failed, and the swap then keeps the current model.
+    """
+    def load():
+        try:
+            model.load_checkpoint(folder=data["folder"], filename=data["filename"])
+        except Exception as e:
+            print("[NNetWorker] Could not load " + data["filename"] + ": " + str(e))
+            data["failed"] = True
+        loaded.set()
+
+    thread = threading.Thread(target=load)
+    thread.daemon = True
+    thread.start()
+
+
+def request_size(data):
+    """
+    Returns:
+        n: the number of boards of a predict or predict_batch request
+    """
+    if "shared" in data:
+        return data["shared"]
+    return len(data["boards"]) if data["inst"] == "predict_batch" else 1
+
+
+def request_boards(slots, channel, data):
+    """
+    Returns:
+        boards: the boards of a predict or predict_batch request, stacked
+    """
+    if "shared" in data:
+        return slots.boards[channel, :data["shared"]]
+    return data["boards"] if data["inst"] == "predict_batch" else data["board"][np.newaxis]
+
+
+def done(nsync, data):
+    """
+    Takes the load of an answered request off the in-flight counter.
+    """
+    with nsync.inflight.get_lock():
+        nsync.inflight.value -= data["load"]
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class PredictSlots():
+    """
+    Boards, policies and values of the predict requests in shared memory,
+    size boards per response channel. A thread has at most one predict in
+    flight, so the slots of its channel are free whenever it sends one:
+    it writes the boards there, queues only their number, and reads the
+    policies and values the NNetWorker wrote back once it is answered.
+    """
+    def __init__(self, game, channels, size):
+        self.size = size
+        action_size = game.getActionSize()
+        board = np.asarray(game.getInitBoard())
+        dtype = np.dtype(board.dtype)
+
+        self.boards = np.frombuffer(mp.RawArray('b', channels*size*board.size*dtype.itemsize), dtype=dtype).reshape((channels, size) + board.shape)
+        self.pis = np.frombuffer(mp.RawArray('f', channels*size*action_size), dtype=np.float32).reshape(channels, size, action_size)
+        self.vs = np.frombuffer(mp.RawArray('f', channels*size), dtype=np.float32).reshape(channels, size)
+
+
+class BatchStats():
+    """
+    Batch sizes and request latencies of an NNetWorker.
+    """
+    def __init__(self, keep=10000):
+        self.latencies = deque([], maxlen=keep)   # stores seconds from put() to the result of the last requests
+        self.requests = 0
+        self.boards = 0
+        self.batches = 0
+        self.busy = 0.0     # stores seconds spent in forward passes
+        self.start = time.time()
+
+    def request(self, latency):
+        self.requests += 1
+        self.latencies.append(latency)
+
+    def batch(self, size):
+        self.batches += 1
+        self.boards += size
+
+    def summary(self):
+        """
+        Returns:
+            stats: dict with the number of requests, boards and batches, the
+                   mean batch size, the boards evaluated per second, the
+                   fraction of the time spent in forward passes and the
+                   50th, 90th and 99th percentile of the request latency in
+                   milliseconds
+        """
+        latencies = np.array(self.latencies) * 1000 if self.latencies else np.zeros(1)
+        elapsed = max(time.time() - self.start, 1e-8)
+        return {'requests': self.requests, 'boards': self.boards, 'batches': self.batches,
+                'mean_batch': self.boards / max(self.batches, 1),
+                'boards/sec': self.boards / elapsed, 'busy': self.busy / elapsed,
+                'p50_ms': float(np.percentile(latencies, 50)), 'p90_ms': float(np.percentile(latencies, 90)),
+                'p99_ms': float(np.percentile(latencies, 99))}
 
 
 class NNetManager():
-    def __init__(self, nnet_workers, os_supported):
+    """
+    Client side of the NNetWorkers, shared by every process forked after it
+    is created.
+
+    Every thread that talks to the workers claims one of num_channels
+    response pipes the first time it does, and gets all of its results on
+    that pipe: a worker sends each result straight to the pipe named in
+    the request.
+
+    Requests go to the worker with the least boards in flight, counted in
+    shared memory so every process sees the load put on the workers by
+    the others.
+
+    Given the game, predict requests of up to slot_boards boards pass their
+    boards, policies and values through PredictSlots instead of pickling
+    them through the queue and the pipe.
+
+    swap() rolls a new model out to the workers without pausing the
+    predicts, and versions() tells a thread which models answered its
+    predicts.
+    """
+    def __init__(self, nnet_workers, os_supported, cache=None, num_channels=64, game=None, slot_boards=8):
         self.global_lock = mp.Lock()
         self.nsyncs = []
-        self.curr = 0
+        self.curr = mp.RawValue('i', 0)     # stores the worker the scheduler looks at first
+        self.scheduled = np.frombuffer(mp.RawArray('q', nnet_workers), dtype=np.int64)  # stores requests put on each worker
 
         self.os_supported = os_supported
+        self.cache = cache      # optional EvalCache shared by all processes
 
         assert(nnet_workers > 0)
 
+        # response channels, the receive end is read by the thread that
+        # claimed it, the send end written by the nnet workers
+        pipes = [mp.Pipe(duplex=False) for _ in range(num_channels)]
+        self.receivers = [r for r, _ in pipes]
+        self.responses = [w for _, w in pipes]
+        self.owners = np.frombuffer(mp.RawArray('q', num_channels*2), dtype=np.int64).reshape(num_channels, 2)
+        self.local = threading.local()
+
+        self.slots = PredictSlots(game, num_channels, slot_boards) if game is not None else None
+
         for i in range(nnet_workers):
-            self.nsyncs.append(NNetSync())
+            self.nsyncs.append(NNetSync(self.responses, self.slots))
 
     def nsync(self, i):
         return self.nsyncs[i]
 
-    def incr_counter(self):
-        return 0 if self.curr >= len(self.nsyncs) - 1 else self.curr + 1
+    def channel(self):
+        """
+        Returns:
+            channel: the response channel of the calling thread, claimed on
+                     first use. Channels of exited processes and threads
+                     are reused.
+        """
+        pid = os.getpid()
+        if getattr(self.local, "pid", None) == pid:
+            return self.local.channel
+
+        tid = threading.get_ident()
+        threads = set(t.ident for t in threading.enumerate())
+        with self.global_lock:
+            for channel, (owner, owner_tid) in enumerate(self.owners):
+                if owner == 0 or (owner == pid and owner_tid not in threads) or \
+                        (owner != pid and not process_alive(owner)):
+                    self.owners[channel] = (pid, tid)
+                    break
+            else:
+                raise RuntimeError("All {} nnet response channels are in use".format(len(self.owners)))
+
+        self.local.pid = pid
+        self.local.channel = channel
+        self.local.early = {}   # stores results received while waiting for another one
+        self.local.oldest = None    # stores oldest and newest model version that answered a predict
+        self.local.newest = None
+        return channel
+
+    def incr_counter(self, q_idx):
+        return 0 if q_idx >= len(self.nsyncs) - 1 else q_idx + 1
 
     def schedule(self):
         """
-        Round robin scheduler. Just grab queues in order because each job
-        is relatively the same in terms of computational time required. Maybe
-        look into putting a job on the least busy queue? Prob not necessary,
-        and could actually be worse because of the extra overhead.
+        Least loaded scheduler. Picks the queue with the fewest boards in
+        flight; ties are broken round robin, so idle workers share the
+        requests instead of all of them going to the first one.
             @return the index of the queue
         """
 
         self.global_lock.acquire() # Protect critical section
 
-        q_idx = self.curr
-        self.curr = self.incr_counter()
+        q_idx = self.curr.value
+        best = None
+        for k in range(len(self.nsyncs)):
+            load = self.nsyncs[q_idx].inflight.value
+            if best is None or load < best[0]:
+                best = (load, q_idx)
+            q_idx = self.incr_counter(q_idx)
+        q_idx = best[1]
+        self.curr.value = self.incr_counter(q_idx)
 
         self.global_lock.release()
 
@@ -99,50 +389,93 @@ class NNetManager():
         """
         Put data on the work_queue returned by schedule(). Non-blocking.
             @args(data) work to put on queue
-            @return tuple of index of queue and data_id of data
+            @return tuple of the response channel and data_id of data
         """
 
         # Get a queue according to scheduler if one isn't already provided
         if q_idx is None: q_idx = self.schedule()
 
+        # Count the request as in flight until the worker answers it
+        data["load"] = request_size(data) if data["inst"] in ("predict", "predict_batch") else 1
+        with self.nsyncs[q_idx].inflight.get_lock():
+            self.nsyncs[q_idx].inflight.value += data["load"]
+            self.scheduled[q_idx] += 1
+
         # Generate a 256-bit random hex string
         data_id = "%x" % random.getrandbits(256)
+        data["sent"] = time.time()
 
         # Put work on queue
-        self.nsyncs[q_idx].work_queue.put((data_id, data))
+        channel = self.channel()
+        self.nsyncs[q_idx].work_queue.put((data_id, channel, data))
 
-        return (q_idx, data_id)
+        return (channel, data_id)
 
 
-    def get(self, q_idx, data_id):
+    def get(self, channel, data_id):
         """
-        Blocks until data with data_id is put on done_queue at q_idx.
-            @args(q_idx) index of done_queue to get from
+        Blocks until the result of data_id arrives on channel.
+            @args(channel) response channel returned by put()
             @args(data_id) data_id of data we are waiting for
-            @return data from done_queue
+            @return result of the request
         """
+        early = self.local.early
+        while data_id not in early:
+            res_id, version, res = self.receivers[channel].recv()
+            early[res_id] = (version, res)
+        version, res = early.pop(data_id)
+        self.local.version = version    # model version of the worker that answered
+        return res
 
-        while True:
-            # Make sure no other get threads are pulling from the queue
-            self.nsyncs[q_idx].done_lock.acquire()
-
-            # Check every item currently in the queue
-            done_queue = self.nsyncs[q_idx].done_queue
-            size = done_queue.qsize() if self.os_supported else 1 # Workaround for non-UNIX systems
-            for i in range(size):
-                tup = done_queue.get()
 
-                # Check if item is our item (ie. if the ids match)
-                if tup[0] == data_id:
-                    self.nsyncs[q_idx].done_lock.release()
-                    return tup[1]
+    def versions(self):
+        """
+        Returns:
+            oldest, newest: the oldest and newest model version that
+                            answered a predict of the calling thread since
+                            the last call, None if none did (e.g. all of
+                            them came from the cache)
+        """
+        self.channel()
+        oldest, newest = self.local.oldest, self.local.newest
+        self.local.oldest = self.local.newest = None
+        return oldest, newest
 
-                # Nope, not our item, put it back on the done_queue 
-                # for someone else to grab
-                done_queue.put(tup)
 
-            # Didn't find our item, try again..
-            self.nsyncs[q_idx].done_lock.release()
+    def evaluate(self, inst, boards):
+        """
+        Sends a predict (boards is one board) or predict_batch (boards is a
+        stack of them) request and blocks until its result arrives, through
+        the PredictSlots of the calling thread when the boards fit.
+            @return pi, v for predict, pis, vs for predict_batch
+        """
+        data = dict()
+        data["inst"] = inst
+
+        n = len(boards) if inst == "predict_batch" else 1
+        if self.slots is None or n > self.slots.size:
+            data["boards" if inst == "predict_batch" else "board"] = boards
+            channel, data_id = self.put(data)
+            res = self.get(channel, data_id)  # Blocks here
+        else:
+            channel = self.channel()
+            self.slots.boards[channel, :n] = boards
+            data["shared"] = n
+
+            channel, data_id = self.put(data)
+            self.get(channel, data_id)  # Blocks here
+
+            # Copy out, the slots are reused by the next request
+            pis = self.slots.pis[channel, :n].copy()
+            vs = self.slots.vs[channel, :n, np.newaxis].copy()
+            res = (pis[0], vs[0]) if inst == "predict" else (pis, vs)
+
+        version = self.local.version
+        if self.local.oldest is None or version < self.local.oldest:
+            self.local.oldest = version
+        if self.local.newest is None or version > self.local.newest:
+            self.local.newest = version
+        return res
 
 
     def predict(self, board):
@@ -150,16 +483,59 @@ class NNetManager():
         Predict() is thread-safe, it can be called concurrently from 
         different threads.
         """
-        data = dict()
-        data["inst"] = "predict"
-        data["board"] = board
+        if self.cache is not None:
+            version = self.cache.getVersion()
+            res = self.cache.get(board)
+            if res is not None:
+                return res
+
+        res = self.evaluate("predict", board)
 
-        q_idx, data_id = self.put(data)
-        res = self.get(q_idx, data_id)  # Blocks here
+        if self.cache is not None:
+            self.cache.put(board, version, *res)
 
         return res
 
 
+    def predict_batch(self, boards):
+        """
+        Same as predict() for a stack of boards, all of them are evaluated
+        by one NNet in a single forward pass.
+        """
+        if self.cache is None:
+            return self.evaluate("predict_batch", boards)
+
+        # Only send the boards that are not cached
+        version = self.cache.getVersion()
+        cached = [self.cache.get(board) for board in boards]
+        missing = [i for i, res in enumerate(cached) if res is None]
+        if missing:
+            pis, vs = self.evaluate("predict_batch", boards[missing])
+
+            for i, pi, v in zip(missing, pis, vs):
+                self.cache.put(boards[i], version, pi, v)
+                cached[i] = (pi, v)
+
+        pis, vs = zip(*cached)
+        return np.array(pis), np.array(vs)
+
+
+    def stats(self):
+        """
+        Returns:
+            stats: list with the BatchStats summary of every NNetWorker,
+                   with the number of requests scheduled on it and the
+                   boards in flight
+        """
+        load = [(int(self.scheduled[i]), nsync.inflight.value) for i, nsync in enumerate(self.nsyncs)]
+        metadata = [self.put({"inst": "stats"}, q_idx=i) for i in range(len(self.nsyncs))]
+        stats = [self.get(channel, data_id) for channel, data_id in metadata]
+        for summary, (scheduled, inflight) in zip(stats, load):
+            summary['scheduled'] = scheduled
+            summary['inflight'] = inflight
+        return stats
+
+
     def train(self, example):
         """
         Train() is not thread-safe, it should not be called concurrently
@@ -169,8 +545,11 @@ class NNetManager():
         data["inst"] = "train"
         data["examples"] = example
 
-        q_idx, data_id = self.put(data, q_idx=0) # Send instruction to first nnet
-        self.get(q_idx, data_id)                 # Blocks here
+        channel, data_id = self.put(data, q_idx=0) # Send instruction to first nnet
+        self.get(channel, data_id)                 # Blocks here
+
+        if self.cache is not None:
+            self.cache.invalidate()
 
         # Done
 
@@ -185,8 +564,8 @@ class NNetManager():
         data["folder"] = folder
         data["filename"] = filename
 
-        q_idx, data_id = self.put(data, q_idx=0) # Send instruction to first nnet
-        self.get(q_idx, data_id)                 # Blocks here
+        channel, data_id = self.put(data, q_idx=0) # Send instruction to first nnet
+        self.get(channel, data_id)                 # Blocks here
 
         # Done
 
@@ -207,8 +586,42 @@ class NNetManager():
             metadata.append(self.put(data, q_idx=i))
 
         # Wait for all nnets to finish
-        for q_idx, data_id in metadata:
-            self.get(q_idx, data_id)    # Blocks here
+        for channel, data_id in metadata:
+            self.get(channel, data_id)    # Blocks here
+
+        # Cached predictions were made with the old weights
+        if self.cache is not None:
+            self.cache.invalidate()
+
+        # Done
+
+
+    def swap(self, folder='checkpoint', filename='checkpoint.pth.tar', version=0):
+        """
+        Hot swap. Every nnet loads the checkpoint in the background and
+        swaps it in as model version between two batches, so predicts go
+        on while it loads (see NNetWorker). Blocks until every nnet swapped.
+        Swap() is not thread-safe, it should not be called concurrently
+        from different threads.
+        """
+        data = dict()
+        data["inst"] = "swap"
+        data["folder"] = folder
+        data["filename"] = filename
+        data["version"] = version
+
+        # Send swap requests to every nnet
+        metadata = []
+        for i in range(len(self.nsyncs)):
+            metadata.append(self.put(data, q_idx=i))
+
+        # Wait for all nnets to swap
+        for channel, data_id in metadata:
+            self.get(channel, data_id)    # Blocks here
+
+        # Cached predictions were made with the old weights
+        if self.cache is not None:
+            self.cache.invalidate()
 
         # Done
 
@@ -0,0 +1,167 @@
+from multiprocessing.connection import Listener
+import os
+import time
+import threading, queue
+
+
+AUTHKEY_ENV = 'BROKER_AUTHKEY'              # environment variable holding the authkey
+AUTHKEY_FILE_ENV = 'BROKER_AUTHKEY_FILE'    # environment variable naming a file holding it
+
+
+def broker_authkey(authkey=None):
+    """
+    Returns:
+        authkey: authkey as bytes if given, else the content of the
+                 BROKER_AUTHKEY environment variable or of the file named
+                 by BROKER_AUTHKEY_FILE, None if neither is set
+    """
+    if authkey is None and os.environ.get(AUTHKEY_ENV):
+        authkey = os.environ[AUTHKEY_ENV]
+    if authkey is None and os.environ.get(AUTHKEY_FILE_ENV):
+        with open(os.environ[AUTHKEY_FILE_ENV], 'rb') as f:
+            authkey = f.read().strip()
+    if isinstance(authkey, str):
+        authkey = authkey.encode()
+    return authkey or None
+
+
+class Broker():
+    """
+    Transport between Coach and self-play workers running on other
+    machines. It offers the same work_queue / done_queue pair as the local
+    worker pool, so learn() and learnAsync() do not know where their
+    episodes are played, and serves them to workers connecting with
+    multiprocessing.connection.Client. address is a (host, port) tuple for
+    TCP or a path for a Unix socket.
+
+    Workers may connect and disconnect at any time: the episode a worker
+    was playing when its connection dropped is put back on work_queue for
+    another worker. Workers pull the weights of a new model version through
+    the broker, see Coach.remoteWorker() for the protocol.
+
+    Connections unpickle what the workers send, so a TCP address needs an
+    authkey (see broker_authkey()): anyone who knows it can run code on
+    the master. It must be kept secret, not committed with the config.
+    """
+    def __init__(self, address, authkey=None):
+        authkey = broker_authkey(authkey)
+        if authkey is None and isinstance(address, tuple):
+            raise ValueError("A broker on a TCP address needs an authkey, set brokerAuthkey or the " +
+                             AUTHKEY_ENV + " or " + AUTHKEY_FILE_ENV + " environment variable")
+        self.authkey = authkey
+        self.work_queue = queue.Queue()
+        self.done_queue = queue.Queue()
+        self.listener = Listener(address, authkey=authkey)
+        self.address = self.listener.address
+        self.model = None           # stores (version, weights) of the published model
+        self.workers = {}           # stores progress of every worker that ever connected
+        self.lock = threading.Lock()
+        self.closed = False
+
+        thread = threading.Thread(target=self.accept)
+        thread.daemon = True
+        thread.start()
+
+    def publish(self, version, filepath):
+        """
+        Makes the checkpoint in filepath the model workers pull for version.
+        """
+        with open(filepath, "rb") as f:
+            self.model = (version, f.read())
+
+    def accept(self):
+        while not self.closed:
+            try:
+                conn = self.listener.accept()
+            except (OSError, EOFError):
+                continue    # closed, or a client failed the handshake
+            thread = threading.Thread(target=self.serve, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def serve(self, conn):
+        """
+        Answers the requests of one worker until it disconnects or is
+        stopped.
+        """
+        try:
+            name = conn.recv()["worker"]
+        except (EOFError, OSError):
+            conn.close()
+            return
+
+        progress = {"episodes": 0, "examples": 0, "version": None, "playing": None,
+                    "seen": time.time(), "connected": True}
+        with self.lock:
+            self.workers[name] = progress
+        print("[Broker] Worker " + name + " joined")
+
+        data = None     # the episode the worker is playing
+        try:
+            while True:
+                req = conn.recv()
+                progress["seen"] = time.time()
+
+                if req["inst"] == "model":
+                    version, weights = self.model
+                    conn.send({"version": version, "weights": weights})
+
+                elif req["inst"] == "work":
+                    while data is None:
+                        if self.closed:
+                            data = {"inst": "stop"}
+                            break
+                        try:
+                            data = self.work_queue.get(timeout=1)
+                        except queue.Empty:
+                            pass
+                    conn.send(data)
+                    if data["inst"] == "stop":
+                        data = None
+                        break
+                    progress["playing"] = data["i"]
+
+                elif req["inst"] == "done":
+                    self.done_queue.put(req["result"])
+                    data = None
+                    progress["episodes"] += 1
+                    progress["examples"] += len(req["result"][3][2])
+                    progress["version"] = req["result"][1]
+                    progress["playing"] = None
+
+        except (EOFError, OSError):
+            pass
+        finally:
+            if data is not None:
+                self.work_queue.put(data)   # another worker plays it
+            conn.close()
+            progress["playing"] = None
+            progress["connected"] = False
+            print("[Broker] Worker " + name + " left")
+
+    def connected(self):
+        """
+        Returns:
+            n: the number of workers connected right now
+        """
+        with self.lock:
+            return sum(1 for progress in self.workers.values() if progress["connected"])
+
+    def report(self):
+        """
+        Prints the progress of every worker.
+        """
+        with self.lock:
+            workers = sorted(self.workers.items())
+        for name, progress in workers:
+            print("[Broker] {} {} | {} episodes, {} examples, model version {}, playing episode {}, seen {:.0f}s ago".format(
+                  name, "connected" if progress["connected"] else "left", progress["episodes"], progress["examples"],
+                  progress["version"], progress["playing"], time.time() - progress["seen"]))
+
+    def close(self):
+        """
+        Stops accepting workers. Every connected worker is told to stop on
+        its next request for work.
+        """
+        self.closed = True
+        self.listener.close()
@@ -5,116 +5,483 @@ import numpy as np
 from pytorch_classification.utils import Bar, AverageMeter
 from chess.keras.NNet import NNetWrapper as nn
 import time, os, sys
-from pickle import Pickler, Unpickler
+from pickle import Unpickler
 from random import shuffle
 from chess.ChessUtil import decode_move
 from chess.ChessGame import display
 import multiprocessing as mp
+import threading, queue
 import copy
+import json
 import random
+from ReplayBuffer import ReplayBuffer
+from ExampleRing import ExampleRing
+from Broker import Broker
+from multiprocessing.connection import Client
+import socket
 from utils import *
 
+EPS = 1e-8
+
 
 class Coach():
     """
     This class executes the self-play + learning. It uses the functions defined
     in Game and NeuralNet. args are specified in main.py.
     """
-    def __init__(self, game, nnet, args):
+    def __init__(self, game, nnet, args, selfPlayOnly=False):
         self.game = game
         self.nnet = nnet
-        self.pnet = nn(self.game)  # the competitor network
         self.args = args
+        # the competitor network, remote workers (selfPlayOnly) never train or pit
+        self.pnet = nn(self.game) if not selfPlayOnly else None
+        # the candidate network of learnAsync()'s gater, built before any
+        # weights are loaded as a new keras NNet replaces the session
+        self.gnet = nn(self.game) if self.args.get('asyncPipeline') and not selfPlayOnly else None
         self.mcts = MCTS(self.game, self.nnet, self.args)
-        self.trainExamplesHistory = []    # history of examples from args.numItersForTrainExamplesHistory latest iterations
+        # examples from the args.numItersForTrainExamplesHistory latest iterations
+        self.replay = ReplayBuffer(os.path.join(self.args.checkpoint, 'replay'), self.args.numItersForTrainExamplesHistory)
+        self.replayAdopted = False     # set once loadState() or loadTrainExamples() took over a store
         self.skipFirstSelfPlay = False # can be overriden in loadTrainExamples()
+        self.startIter = 1                # can be overriden in loadState()
+        self.resumeStage = None           # stage of startIter to resume at, see loadState()
+        self.modelVersion = 0             # bumped every time a new model is accepted
+        self.workers = []                 # self-play worker pool, see startWorkers()
 
+        # shared slots the workers write their examples into, see ExampleRing
+        ringSize = self.args.get('exampleRingSize', 0)
+        self.ring = ExampleRing(self.game, ringSize) if ringSize > 0 and not self.args.get('brokerAddress') else None
 
-    # DEPRICATED -- use coach_worker instead
-    # def executeEpisode(self):
-    #     """
-    #     This function executes one episode of self-play, starting with player 1.
-    #     As the game is played, each turn is added as a training example to
-    #     trainExamples. The game is played till the game ends. After the game
-    #     ends, the outcome of the game is used to assign values to each example
-    #     in trainExamples.
+        # transport to the workers when self-play is distributed, see startWorkers()
+        self.broker = None
 
-    #     It uses a temp=1 if episodeStep < tempThreshold, and thereafter
-    #     uses temp=0.
+        self.nextEpisode = 0                      # id of the next episode handed to the workers
+        self.cancelBelow = mp.Value('q', 0)       # episodes with a lower id are abandoned by the workers
+        self.plies = mp.RawArray('i', max(self.args.get('mcts_workers', 1), 1))   # length of the game each local worker is playing
 
-    #     Returns:
-    #         trainExamples: a list of examples of the form (canonicalBoard,pi,v)
-    #                        pi is the MCTS informed policy vector, v is +1 if
-    #                        the player eventually won the game, else -1.
-    #     """
-    #     trainExamples = []
-    #     board = self.game.getInitBoard()
-    #     self.curPlayer = 1
-    #     episodeStep = 0
 
-    #     while True:
-    #         episodeStep += 1
-    #         canonicalBoard = self.game.getCanonicalForm(board,self.curPlayer)
-    #         temp = int(episodeStep < self.args.tempThreshold)
-    #         pi = self.mcts.getActionProb(canonicalBoard, temp=temp)
-    #         sym = self.game.getSymmetries(canonicalBoard, pi)
-    #         for b,p in sym:
-    #             trainExamples.append([b, self.curPlayer, p, None])
+    def executeEpisode(self, game, progress=None):
+        """
+        This function executes one episode of self-play on game, starting with
+        player 1. As the game is played, each fully searched turn is added as
+        a training example. The game is played till the game ends. After the
+        game ends, the outcome of the game is used to assign values to each
+        example.
+
+        It uses a temp=1 if episodeStep < tempThreshold, and thereafter
+        uses temp=0.
+
+        progress, if given, is called with the number of plies played after
+        every move; the episode is abandoned as soon as it returns False.
+
+        Returns:
+            boards, pis, vs: the examples of the episode, one entry per
+                             example. pi is the MCTS informed policy as a
+                             sparse (actions, probs) pair, see
+                             utils.sparse_policy; v is +1 if the player
+                             eventually won the game, else -1.
+                             None if the episode was abandoned.
+        """
+        episode = self.newEpisode(game, progress)
+        boards = self.advanceEpisode(episode)
+        while boards is not None:
+            boards = self.advanceEpisode(episode, self.nnet.predict_batch(boards))
+        return episode["result"]
 
-    #         action = np.random.choice(len(pi), p=pi)
-            
-    #         board, self.curPlayer = self.game.getNextState(board, self.curPlayer, action)
 
-    #         r = self.game.getGameEnded(board, self.curPlayer)
+    def newEpisode(self, game, progress=None):
+        """
+        Returns:
+            episode: the state of a new episode of self-play on game, played
+                     by advanceEpisode()
+        """
+        return {"game": game, "mcts": MCTS(game, self.nnet, self.args), "board": game.getInitBoard(),
+                "curPlayer": 1, "episodeStep": 0, "trainExamples": [], "steps": None,
+                "progress": progress, "done": False, "result": None}
 
-    #         if r!=0:
-    #             return [(x[0],x[2],r*((-1)**(x[1]!=self.curPlayer))) for x in trainExamples]
+
+    def advanceEpisode(self, episode, predictions=None):
+        """
+        Plays episode until its search needs the nnet, see MCTS.searchSteps.
+        predictions are the (pis, vs) for the boards returned by the
+        previous call.
+
+        Returns:
+            boards: the boards to evaluate before the next call, or None once
+                    the episode is over (episode["done"]); its examples are
+                    then in episode["result"], see executeEpisode()
+        """
+        game = episode["game"]
+        while True:
+            if episode["steps"] is None:
+                episode["episodeStep"] += 1
+                canonicalBoard = game.getCanonicalForm(episode["board"], episode["curPlayer"])
+
+                # Keep the subtree of the move that was played, free the rest
+                episode["mcts"].advanceRoot(canonicalBoard)
+
+                temp = int(episode["episodeStep"] < self.args.tempThreshold)
+
+                # Playout cap randomization: only a fraction of the moves get
+                # a full search (with root noise) and become training examples,
+                # the others are played from a cheap search
+                full_search = random.random() < self.args.get('playoutCapProb', 1)
+                if full_search:
+                    episode["steps"] = episode["mcts"].searchSteps(canonicalBoard, temp=temp, noise=True)
+                else:
+                    episode["steps"] = episode["mcts"].searchSteps(canonicalBoard, temp=temp, sims=self.args.numMCTSSimsFast)
+                episode["canonicalBoard"] = canonicalBoard
+                episode["full_search"] = full_search
+
+            try:
+                return episode["steps"].send(predictions)
+            except StopIteration as stop:
+                pi = stop.value
+            episode["steps"] = None
+            predictions = None
+
+            curPlayer = episode["curPlayer"]
+            trainExamples = episode["trainExamples"]
+            if episode["full_search"]:
+                sym = game.getSymmetries(episode["canonicalBoard"], pi)
+                for b, p in sym:
+                    trainExamples.append([b, curPlayer, p])
+
+            action = np.random.choice(len(pi), p=pi)
+            board, curPlayer = game.getNextState(episode["board"], curPlayer, action)
+            episode["board"], episode["curPlayer"] = board, curPlayer
+            res = game.getGameEnded(board, curPlayer)
+
+            if res != 0:
+                boards = np.array([x[0] for x in trainExamples])
+                pis = [sparse_policy(x[2]) for x in trainExamples]
+                vs = np.array([res * ((-1) ** (x[1] != curPlayer)) for x in trainExamples], dtype=np.float32)
+                episode["result"] = (boards, pis, vs)
+                episode["done"] = True
+                return None
+
+            if episode["progress"] is not None and not episode["progress"](episode["episodeStep"]):
+                episode["done"] = True
+                return None
 
 
     def coach_worker(self, work_queue, done_queue, i):
         """
-        Localized version of learn() and executeEpisode() that is thread-safe. Args
-        game, nnet, and args should be their own localized copies. This function may
-        mutate these objects.
+        Self-play worker of the pool started by startWorkers(). It lives
+        across iterations: every "play" message on work_queue is one episode,
+        a "stop" message ends the worker. The worker plays on its own copy
+        of the game (inherited when it was forked) and tags each result with
+        the oldest model version that evaluated its positions, see
+        playedVersion().
         """
 
         print("[Coach Worker " + str(i) + "] Started!")
 
+        # Forked workers inherit the numpy random state of the master
+        np.random.seed()
+
+        game = self.game
+        version = None
+
         # Grab work from queue and decode the work data
         while True:
             data = work_queue.get()
-            game = data["game"]
+            if data["inst"] == "stop":
+                break
 
-            start = time.time()
+            if data["version"] != version:
+                version = data["version"]
+                print("[Coach Worker " + str(i) + "] Playing with model version " + str(version))
 
-            # Create our MCTS instance
-            mcts = MCTS(game, self.nnet, self.args)
+            if self.args.get('lockstepGames', 1) > 1:
+                self.lockstepWorker(work_queue, done_queue, i, data)
+                break
 
-            # Start "executeEpisode()"
-            trainExamples = []
-            board = game.getInitBoard()
-            curPlayer = 1
-            episodeStep = 0
+            # report the length of the game, and give up once the master
+            # has cancelled it
+            def progress(plies):
+                self.plies[i] = plies
+                return data["i"] >= self.cancelBelow.value
 
-            while True:
-                episodeStep += 1
-                canonicalBoard = game.getCanonicalForm(board, curPlayer)
+            start = time.time()
+            self.playedVersion(None)
+            examples = self.executeEpisode(game, progress)
+            self.plies[i] = 0
+            examples = self.packExamples(examples)
+            done_queue.put((data["i"], self.playedVersion(version), time.time() - start, examples))
 
-                temp = int(episodeStep < self.args.tempThreshold)
-                pi = mcts.getActionProb(canonicalBoard, temp=temp)
+        print("[Coach Worker " + str(i) + "] Stopped!")
 
-                sym = game.getSymmetries(canonicalBoard, pi)
-                for b, p in sym:
-                    trainExamples.append([b, curPlayer, p, None])
 
-                action = np.random.choice(len(pi), p=pi)
-                board, curPlayer = game.getNextState(board, curPlayer, action)
-                res = game.getGameEnded(board, curPlayer)
+    def lockstepWorker(self, work_queue, done_queue, i, data):
+        """
+        Body of coach_worker with args.lockstepGames = n > 1: the worker
+        plays up to n episodes at once, each on its own copy of the game and
+        with its own MCTS, starting with the one of message data. Their
+        searches are stepped together so the leaves of all of them go to the
+        nnet in one predict_batch call (see MCTS.searchSteps). A finished
+        episode is sent right away and its place taken by the next message
+        on work_queue, if there is one.
+        """
+        episodes = []
+        stopping = False
+        while True:
+            # Top up with new episodes, only wait for one when idle
+            while data is not None or (not stopping and len(episodes) < self.args.lockstepGames):
+                if data is None:
+                    try:
+                        data = work_queue.get(block=not episodes)
+                    except queue.Empty:
+                        break
+                if data["inst"] == "stop":
+                    stopping = True
+                    data = None
+                    break
 
-                if res != 0:
-                    examples = [(x[0], x[2], res * ((-1) ** (x[1] != curPlayer))) for x in trainExamples]
-                    done_queue.put((time.time() - start, examples))
+                progress = lambda plies, eps=data["i"]: eps >= self.cancelBelow.value
+                episode = self.newEpisode(copy.deepcopy(self.game), progress)
+                episode["data"], episode["start"], episode["version"] = data, time.time(), None
+                episode["boards"] = self.advanceEpisode(episode)
+                episodes.append(episode)
+                data = None
+
+            for episode in [e for e in episodes if e["done"]]:
+                episodes.remove(episode)
+                examples = episode["result"]
+                examples = self.packExamples(examples)
+                version = episode["version"] if episode["version"] is not None else episode["data"]["version"]
+                done_queue.put((episode["data"]["i"], version, time.time() - episode["start"], examples))
+
+            if not episodes:
+                if stopping:
                     break
+                continue
+            self.plies[i] = max(e["episodeStep"] for e in episodes)
+
+            # One nnet call for the leaves of every episode
+            boards = np.concatenate([e["boards"] for e in episodes])
+            pis, vs = self.nnet.predict_batch(boards)
+            answered = self.playedVersion(None)
+            offset = 0
+            for episode in episodes:
+                if answered is not None and (episode["version"] is None or answered < episode["version"]):
+                    episode["version"] = answered
+                n = len(episode["boards"])
+                episode["boards"] = self.advanceEpisode(episode, (pis[offset:offset+n], vs[offset:offset+n]))
+                offset += n
+        self.plies[i] = 0
+
+
+    def startWorkers(self):
+        """
+        Starts the pool of args.mcts_workers self-play workers, if it is not
+        running yet. The pool is reused by every iteration.
+
+        With args.brokerAddress set, self-play is distributed: a Broker
+        listens on that address for workers started on other machines with
+        selfplay-worker.py, and the args.mcts_workers local workers connect
+        to it like the remote ones.
+        """
+        if self.workers or self.broker is not None:
+            return
+
+        print("[Master] Spawning Workers...")
+
+        if self.args.get('brokerAddress'):
+            self.broker = Broker(self.args.brokerAddress, self.args.get('brokerAuthkey'))
+            self.work_queue = self.broker.work_queue
+            self.done_queue = self.broker.done_queue
+            self.nnet.save_checkpoint(folder=self.args.checkpoint, filename='best.pth.tar')
+            self.publishModel()
+            print("[Master] Waiting for self-play workers on " + str(self.broker.address))
+
+            for ep in range(self.args.mcts_workers):
+                # local workers already share the model of the master
+                tup = (self.broker.address, self.broker.authkey, "local-" + str(ep), False)
+                proc = mp.Process(target=self.remoteWorker, args=tup)
+                proc.start()
+
+                self.workers.append(proc)
+            return
+
+        self.work_queue = mp.Queue()
+        self.done_queue = mp.Queue()
+        for ep in range(self.args.mcts_workers):
+            tup = (self.work_queue, self.done_queue, ep)
+            proc = mp.Process(target=self.coach_worker, args=tup)
+            proc.start()
+
+            self.workers.append(proc)
+
+
+    def remoteWorker(self, address, authkey, name=None, pull=True):
+        """
+        Self-play worker of a distributed run, connected to the Broker at
+        address. It asks the broker for work, plays the episode and sends
+        the examples back until the broker tells it to stop. With pull, the
+        weights of every new model version are downloaded from the broker
+        and loaded into self.nnet before the next episode.
+        """
+        name = name or socket.gethostname() + "-" + str(os.getpid())
+        conn = Client(address, authkey=authkey)
+        conn.send({"worker": name})
+        print("[Coach Worker " + name + "] Connected to " + str(address))
+
+        # Forked workers inherit the numpy random state of the master
+        np.random.seed()
+
+        version = None
+        while True:
+            conn.send({"inst": "work"})
+            data = conn.recv()
+            if data["inst"] == "stop":
+                break
+
+            if data["version"] != version:
+                if pull:
+                    conn.send({"inst": "model"})
+                    model = conn.recv()
+                    if not os.path.exists(self.args.checkpoint):
+                        os.makedirs(self.args.checkpoint)
+                    # every worker process of a host has its own file, replaced
+                    # atomically so it never loads a half-written one
+                    filename = 'remote-' + str(os.getpid()) + '.pth.tar'
+                    path = os.path.join(self.args.checkpoint, filename)
+                    with open(path + '.tmp', "wb") as f:
+                        f.write(model["weights"])
+                    os.replace(path + '.tmp', path)
+                    self.nnet.load_checkpoint(folder=self.args.checkpoint, filename=filename)
+                    version = model["version"]
+                else:
+                    version = data["version"]
+                print("[Coach Worker " + name + "] Playing with model version " + str(version))
+
+            start = time.time()
+            examples = self.executeEpisode(self.game)
+            conn.send({"inst": "done", "result": (data["i"], version, time.time() - start, examples)})
+
+        conn.close()
+        print("[Coach Worker " + name + "] Stopped!")
+
+
+    def maxPending(self):
+        """
+        Returns:
+            pending: the number of episodes the master keeps handed out to
+                     the pool, two per worker or args.lockstepGames per
+                     worker if it plays more games at once
+        """
+        return max(self.args.mcts_workers, 1) * max(2, self.args.get('lockstepGames', 1))
+
+
+    def packExamples(self, examples):
+        """
+        Returns:
+            examples: the examples of an episode as a worker sends them to
+                      the master, the list of ExampleRing slots they were
+                      written to, or the (boards, pis, vs) themselves without
+                      a ring or if the episode does not fit in it
+        """
+        if self.ring is None or examples is None:
+            return examples
+        try:
+            return self.ring.write(*examples)    # only send the slots
+        except ValueError as e:
+            print("[Coach Worker] " + str(e) + ", sending it through the queue")
+            return examples
+
+
+    def playedVersion(self, version):
+        """
+        Returns:
+            version: the oldest model version that answered the predicts of
+                     this thread since the last call, see
+                     NNetManager.versions(); the given version if the nnet
+                     does not tell or none did
+        """
+        if hasattr(self.nnet, "versions"):
+            oldest, _ = self.nnet.versions()
+            if oldest is not None:
+                return oldest
+        return version
+
+
+    def rolloutModel(self, filename):
+        """
+        Makes the checkpoint filename in args.checkpoint the model self-play
+        plays with, as version self.modelVersion. An NNetManager swaps it in
+        without pausing the predicts of the workers, see NNetManager.swap().
+        """
+        if hasattr(self.nnet, "swap"):
+            self.nnet.swap(folder=self.args.checkpoint, filename=filename, version=self.modelVersion)
+        else:
+            self.nnet.load_checkpoint(folder=self.args.checkpoint, filename=filename)
+
+
+    def publishModel(self):
+        """
+        Lets the remote workers pull best.pth.tar as model version
+        self.modelVersion.
+        """
+        if self.broker is not None:
+            self.broker.publish(self.modelVersion, os.path.join(self.args.checkpoint, 'best.pth.tar'))
+
+
+    def getEpisode(self, timeout=None):
+        """
+        Waits for the next episode played by the pool.
+
+        Returns:
+            eps, version, runtime, (boards, pis, vs): the episode number, the
+                model version it was played with, its runtime and its
+                examples, read out of the ExampleRing if there is one (None
+                if the episode was cancelled)
+        """
+        eps, version, runtime, examples = self.done_queue.get(timeout=timeout)
+        if isinstance(examples, list):
+            examples = self.ring.read(examples)     # slots, see packExamples()
+        return eps, version, runtime, examples
+
+
+    def stopWorkers(self):
+        """
+        Asks every worker to exit once its current episode is done and
+        waits for them. Workers are only terminated if they do not exit, so
+        none of them dies in the middle of writing to a queue.
+        """
+        if not self.workers and self.broker is None:
+            return
+
+        print("[Master] Stopping workers...")
+
+        # Drop the episodes no worker has started yet
+        while True:
+            try:
+                self.work_queue.get_nowait()
+            except queue.Empty:
+                break
+
+        if self.broker is not None:
+            self.broker.close()     # every worker gets a stop on its next request
+        else:
+            for _ in self.workers:
+                self.work_queue.put({"inst": "stop"})
+
+        # A worker only exits once its results are read, so keep draining
+        deadline = time.time() + 60
+        while (any(p.is_alive() for p in self.workers) or (self.broker is not None and self.broker.connected())) \
+                and time.time() < deadline:
+            try:
+                self.getEpisode(timeout=0.1)
+            except queue.Empty:
+                pass
+
+        for p in self.workers:
+            if p.is_alive():
+                p.terminate()
+            p.join()
+        self.workers = []
+        self.broker = None
 
 
     def learn(self):
@@ -126,105 +493,164 @@ class Coach():
         only if it wins >= updateThreshold fraction of games.
         """
 
-        for i in range(1, self.args.numIters + 1):
+        # a fresh run never trains on what an earlier run left in the folder
+        if not self.replayAdopted:
+            if self.replay.segments:
+                print("Dropping the replay store of an earlier run in " + self.replay.folder +
+                      ", set resume or load_model to keep it")
+            self.replay.reset()
+
+        # the commit tags (iterations) of an earlier run do not apply to
+        # this one, only a resumed run may find its iteration committed
+        if self.resumeStage is None:
+            self.replay.committed = None
+
+        for i in range(self.startIter, self.args.numIters + 1):
             # bookkeeping
             print('------ITER ' + str(i) + '------')
+            resuming = i == self.startIter and self.resumeStage is not None
+            stage = self.resumeStage if resuming else 'selfplay'
+
             # examples of the iteration
-            if not self.skipFirstSelfPlay or i > 1:
-                iterationTrainExamples = deque([], maxlen=self.args.maxlenOfQueue)
+            if stage == 'selfplay' and (not self.skipFirstSelfPlay or i > 1):
+                self.saveState(i, 'selfplay')
+
+                # the episodes of this iteration played before a crash are kept
+                if not resuming:
+                    self.replay.clearPending()
+                played = len(self.replay.pendingFiles())
+                if played > 0:
+                    print("[Master] iter={} resuming after {} episodes".format(i, played))
+
+                # With args.samplesPerIter the iteration ends once that many
+                # examples are in, instead of after numEps episodes, or after
+                # args.samplesMaxEps episodes if it never gets there (e.g.
+                # every game is a filtered draw)
+                samplesTarget = self.args.get('samplesPerIter', 0)
+                maxEps = self.args.get('samplesMaxEps', 4 * self.args.numEps) if samplesTarget else self.args.numEps
+                numExamples = len(self.replay.pendingExamples()) if samplesTarget and played else 0
     
                 tracker = ParallelRuntimes(self.args.mcts_workers)
-                bar = Bar('Self Play', max=self.args.numEps)
+                versions = {}   # stores number of examples played by every model version
+                bar = Bar('Self Play', max=samplesTarget or self.args.numEps - played)
+
+                cache = getattr(self.nnet, "cache", None)
+                cache_start = cache.stats() if cache is not None else None
     
-                # Multiprocess self-play
-                proccesses = []
-                work_queue = mp.Queue()
-                done_queue = mp.Queue()
-
-                print("[Master] Spawning Workers...")
-
-                # Spawn workers
-                for ep in range(self.args.mcts_workers):
-                    tup = (work_queue, done_queue, ep)
-                    proc = mp.Process(target=self.coach_worker, args=tup)
-                    proc.start()
-
-                    proccesses.append(proc)
-
-                print("[Master] Adding work...")
-
-                # Add work to queue
-                for eps in range(self.args.numEps):
-                    data = dict()
-                    data["i"] = eps
-                    data["game"] = copy.deepcopy(self.game)
-
-                    work_queue.put(data)
-
-                print("[Master] Waiting for results...")
-
-                # Wait for results to come in
-                for ep in range(self.args.numEps):
-                    runtime, examples = done_queue.get()
-                    
-                    # Drop 80% of draws
-                    to_add = False
-                    loss_rate = self.args.filter_draw_rate
-                    if abs(examples[0][2]) != 1:
-                        if random.random() >= loss_rate:
-                            to_add = True
+                # Multiprocess self-play on the persistent worker pool
+                self.startWorkers()
+
+                print("[Master] Playing...")
+
+                # Keep every worker busy with one more episode queued behind
+                # it. Every finished episode is saved right away.
+                firstEpisode = self.nextEpisode
+                issued, finished, pending = played, played, 0
+                start = time.time()
+                while (numExamples < samplesTarget if samplesTarget else True) and finished < maxEps:
+                    while pending < self.maxPending() and issued < maxEps:
+                        data = dict()
+                        data["inst"] = "play"
+                        data["i"] = self.nextEpisode
+                        data["version"] = self.modelVersion
+
+                        self.work_queue.put(data)
+                        self.nextEpisode += 1
+                        issued += 1
+                        pending += 1
+
+                    try:
+                        eps, version, runtime, examples = self.getEpisode(timeout=1)
+                    except queue.Empty:
+                        continue
+                    if eps < firstEpisode:
+                        continue    # cancelled at the end of an earlier iteration
+                    pending -= 1
+                    finished += 1
+
+                    if examples is None:
+                        self.replay.appendEpisode([])   # abandoned, it still counts as played
+                        continue
+                    boards, pis, vs = examples
+                    if self.keepEpisode(vs):
+                        self.replay.appendEpisode(list(zip(boards, pis, vs)))
+                        numExamples += len(vs)
+                        versions[version] = versions.get(version, 0) + len(vs)
                     else:
-                        to_add = True
-
-                    if to_add:
-                        iterationTrainExamples += examples
+                        self.replay.appendEpisode([])
 
                     tracker.update(runtime)
-                    bar.suffix = '({eps}/{maxeps}) Eps Time: {et:.3f}s | Total: {total:} | ETA: {eta:}'.format(
-                                  eps=ep + 1, maxeps=self.args.numEps, et=tracker.avg(), total=bar.elapsed_td, 
-                                  eta=tracker.eta(ep + 1, self.args.numEps))
-                    bar.next()
+                    plies = [n for n in self.plies if n > 0]
+                    if samplesTarget:
+                        done = min(numExamples, samplesTarget)
+                        eta = (time.time() - start) * (samplesTarget - done) / max(done, 1)
+                    else:
+                        done = finished
+                        eta = tracker.eta(finished - played, self.args.numEps - played)
+                    bar.suffix = '({done}/{maxdone}) Eps: {eps} Time: {et:.3f}s | Longest in-flight: {plies} plies | Total: {total:} | ETA: {eta:.0f}s'.format(
+                                  done=done, maxdone=samplesTarget or self.args.numEps, eps=finished, et=tracker.avg(),
+                                  plies=max(plies) if plies else 0, total=bar.elapsed_td, eta=eta)
+                    bar.goto(done - (0 if samplesTarget else played))
+
+                # Cancel the episodes still queued or being played
+                self.cancelBelow.value = self.nextEpisode
+                while True:
+                    try:
+                        self.work_queue.get_nowait()
+                    except queue.Empty:
+                        break
+                if samplesTarget:
+                    print("[Master] iter={} {} episodes finished, {} cancelled".format(i, finished, issued - finished))
+                    if numExamples < samplesTarget:
+                        print("[Master] iter={} missed the sample target: {} of {} examples after {} episodes".format(
+                              i, numExamples, samplesTarget, finished))
+
+                print("[Master] iter={} examples by model version: {}".format(
+                      i, ", ".join("v{}: {}".format(v, n) for v, n in sorted(versions.items()))))
+
+                if cache is not None:
+                    cache_end = cache.stats()
+                    hits = cache_end["hits"] - cache_start["hits"]
+                    lookups = hits + cache_end["misses"] - cache_start["misses"]
+                    print("[Master] iter={} eval cache saved {} of {} nnet calls ({:.1f}%)".format(
+                          i, hits, lookups, 100. * hits / max(lookups, 1)))
+                bar.finish()
 
-                print("[Master] Killing workers...")
+                if self.broker is not None:
+                    self.broker.report()
 
-                # Kill workers
-                for p in proccesses:
-                    p.terminate()
-                    p.join()
+                # batching of the nnet workers, see AtomicNeuralNet.NNetWorker
+                if hasattr(self.nnet, "stats"):
+                    for w, stats in enumerate(self.nnet.stats()):
+                        print("[Master] iter={} nnet worker {}: model version {} {} requests {:.0%} busy {:.1f} boards/batch {:.0f} boards/sec latency p50={:.1f}ms p90={:.1f}ms p99={:.1f}ms".format(
+                              i, w, stats["version"], stats["scheduled"], stats["busy"], stats["mean_batch"], stats["boards/sec"], stats["p50_ms"], stats["p90_ms"], stats["p99_ms"]))
 
-                print("[Master] iter={} adding {} examples".format(i, len(iterationTrainExamples)))
-                self.trainExamplesHistory.append(iterationTrainExamples)
+                # move the episodes into the replay store, this also drops
+                # the iterations that fall out of the window
+                added = self.saveTrainExamples(i)
+                print("[Master] iter={} added {} examples".format(i, added))
 
-                bar.finish()
+            if stage != 'arena':
+                self.saveState(i, 'train')
 
-                
-            if len(self.trainExamplesHistory) > self.args.numItersForTrainExamplesHistory:
-                print("len(trainExamplesHistory) =", len(self.trainExamplesHistory), " => remove the oldest trainExamples")
-                self.trainExamplesHistory.pop(0)
-            # backup history to a file
-            # NB! the examples were collected using the model from the previous iteration, so (i-1)  
-            self.saveTrainExamples(i)
-            
-            # shuffle examlpes before training
-            trainExamples = []
-            for e in self.trainExamplesHistory:
-                trainExamples.extend(e)
-            shuffle(trainExamples)
+                # training new network, keeping a copy of the old one
+                self.nnet.save_checkpoint(folder=self.args.checkpoint, filename='temp.pth.tar')
 
-            # training new network, keeping a copy of the old one
-            self.nnet.save_checkpoint(folder=self.args.checkpoint, filename='temp.pth.tar')
+                # the examples are streamed from the replay store in shuffled minibatches
+                self.nnet.train(self.replay)
+                self.nnet.save_checkpoint(folder=self.args.checkpoint, filename='new.pth.tar')
+                self.saveState(i, 'arena')
+            else:
+                self.nnet.load_checkpoint(folder=self.args.checkpoint, filename='new.pth.tar')
 
             # normal network, don't use parallel code
             self.pnet.load_checkpoint(folder=self.args.checkpoint, filename='temp.pth.tar')
-            pmcts = MCTS(copy.deepcopy(self.game), self.pnet, self.args)
-            
-            self.nnet.train(trainExamples)
-
-            nmcts = MCTS(copy.deepcopy(self.game), self.nnet, self.args)
+            pmcts = MCTS(self.game, self.pnet, self.args)
+            nmcts = MCTS(self.game, self.nnet, self.args)
 
             print('PITTING AGAINST PREVIOUS VERSION (player1 = previous, player2 = new)')
-            arena = Arena(lambda x: np.argmax(pmcts.getActionProb(x, temp=0)),
-                          lambda x: np.argmax(nmcts.getActionProb(x, temp=0)), 
+            arena = Arena(self.arenaPlayer(pmcts),
+                          self.arenaPlayer(nmcts),
                           self.game, num_workers=self.args.mcts_workers)
             pwins, nwins, draws = arena.playGames(self.args.arenaCompare)
 
@@ -237,36 +663,271 @@ class Coach():
                 self.nnet.save_checkpoint(folder=self.args.checkpoint, filename=self.getCheckpointFile(i))
                 self.nnet.save_checkpoint(folder=self.args.checkpoint, filename='best.pth.tar')
 
-                # Load so all nnets are updated accordingly
-                self.nnet.load_checkpoint(folder=self.args.checkpoint, filename='best.pth.tar')
+                # Swap it in so all nnets are updated accordingly
+                self.modelVersion += 1
+                self.rolloutModel('best.pth.tar')
+                self.publishModel()
+
+            self.saveState(i + 1, 'selfplay')
+
+        self.stopWorkers()
+
 
+    def learnAsync(self):
+        """
+        Pipelined version of learn(): self-play, training and evaluation run
+        at the same time instead of one after the other.
+
+        - The worker pool plays episodes continuously with the best model and
+          the master thread adds them to a replay buffer of maxlenOfQueue
+          examples.
+        - A trainer thread trains self.pnet on the buffer every time
+          args.asyncTrainSamples new examples came in, and saves every
+          result as a candidate checkpoint.
+        - A gating thread pits the most recent candidate against the best
+          model and, if it wins >= updateThreshold of the games, makes it the
+          best model the workers play with.
+
+        Stops once numIters candidates have been evaluated. The throughput of
+        every stage is printed every args.asyncReportSecs seconds.
+        """
+        self.replayBuffer = deque([], maxlen=self.args.maxlenOfQueue)
+        self.bufferLock = threading.Lock()
+        self.candidates = queue.Queue()
+        self.pipelineStop = threading.Event()
+        self.pipelineStats = {"start": time.time(), "games": 0, "samples": 0, "stale": 0, "trained": 0, "train_time": 0.,
+                              "candidates": 0, "gated": 0, "arena_games": 0, "arena_time": 0.}
+
+        if self.gnet is None:
+            self.gnet = nn(self.game)   # args.asyncPipeline was not set, still before pnet loads
+
+        # The trainer starts from the best model
+        self.nnet.save_checkpoint(folder=self.args.checkpoint, filename='best.pth.tar')
+        self.pnet.load_checkpoint(folder=self.args.checkpoint, filename='best.pth.tar')
+
+        threads = [threading.Thread(target=self.trainer), threading.Thread(target=self.gater)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+
+        self.startWorkers()
+        pending = 0
+        last_report = time.time()
+        while self.pipelineStats["gated"] < self.args.numIters:
+            # Keep every worker busy, with one episode queued up behind it
+            while pending < self.maxPending():
+                self.work_queue.put({"inst": "play", "i": self.nextEpisode, "version": self.modelVersion})
+                self.nextEpisode += 1
+                pending += 1
+
+            try:
+                eps, version, runtime, examples = self.getEpisode(timeout=1)
+            except queue.Empty:
+                pass
+            else:
+                pending -= 1
+                if examples is not None:    # None if the episode was cancelled
+                    boards, pis, vs = examples
+                    self.pipelineStats["games"] += 1
+                    if self.keepEpisode(vs):
+                        with self.bufferLock:
+                            self.replayBuffer.extend(zip(boards, pis, vs))
+                        self.pipelineStats["samples"] += len(vs)
+                        if version is not None and version < self.modelVersion:
+                            self.pipelineStats["stale"] += len(vs)  # played by a model that was replaced
+
+            if time.time() - last_report >= self.args.get('asyncReportSecs', 60):
+                self.reportPipeline()
+                last_report = time.time()
+
+        self.pipelineStop.set()
+        for t in threads:
+            t.join()
+        self.stopWorkers()
+        self.reportPipeline()
+
+
+    def trainer(self):
+        """
+        Training stage of learnAsync().
+        """
+        trained_at = 0
+        while not self.pipelineStop.is_set():
+            if self.pipelineStats["samples"] - trained_at < self.args.get('asyncTrainSamples', 20000):
+                time.sleep(1)
+                continue
+
+            trained_at = self.pipelineStats["samples"]
+            with self.bufferLock:
+                trainExamples = list(self.replayBuffer)
+            shuffle(trainExamples)
+
+            start = time.time()
+            self.pnet.train(trainExamples)
+            self.pipelineStats["train_time"] += time.time() - start
+            self.pipelineStats["trained"] += len(trainExamples)
+
+            self.pipelineStats["candidates"] += 1
+            filename = 'candidate_' + str(self.pipelineStats["candidates"]) + '.pth.tar'
+            self.pnet.save_checkpoint(folder=self.args.checkpoint, filename=filename)
+            self.candidates.put(filename)
+
+
+    def gater(self):
+        """
+        Evaluation stage of learnAsync(). Older candidates still waiting
+        when a newer one arrives are skipped.
+        """
+        game = copy.deepcopy(self.game)
+        gnet = self.gnet
+        while not self.pipelineStop.is_set():
+            try:
+                filename = self.candidates.get(timeout=1)
+            except queue.Empty:
+                continue
+            while not self.candidates.empty():
+                filename = self.candidates.get()
+
+            gnet.load_checkpoint(folder=self.args.checkpoint, filename=filename)
+            bmcts = MCTS(game, self.nnet, self.args)
+            cmcts = MCTS(game, gnet, self.args)
+
+            start = time.time()
+            arena = Arena(self.arenaPlayer(bmcts), self.arenaPlayer(cmcts), game)
+            bwins, cwins, draws = arena.playGames(self.args.arenaCompare)
+            self.pipelineStats["arena_time"] += time.time() - start
+            self.pipelineStats["arena_games"] += self.args.arenaCompare
+            self.pipelineStats["gated"] += 1
+
+            print('[Gating] {} WINS/BEST WINS : {} / {} ; DRAWS : {}'.format(filename, cwins, bwins, draws))
+            if bwins+cwins > 0 and float(cwins)/(bwins+cwins) < self.args.updateThreshold:
+                print('[Gating] REJECTING ' + filename)
+            else:
+                print('[Gating] ACCEPTING ' + filename)
+                # self-play goes on with the old model while the new one loads
+                self.modelVersion += 1
+                self.rolloutModel(filename)
+                self.nnet.save_checkpoint(folder=self.args.checkpoint, filename=self.getCheckpointFile(self.pipelineStats["gated"]))
+                self.nnet.save_checkpoint(folder=self.args.checkpoint, filename='best.pth.tar')
+                self.publishModel()
+
+
+    def reportPipeline(self):
+        """
+        Prints the throughput of every stage of learnAsync().
+        """
+        stats = self.pipelineStats
+        hours = (time.time() - stats["start"]) / 3600.
+        print("[Master] self-play: {:.1f} games/hour, {:.1f} samples/sec, {} from replaced models | training: {:.1f} samples/sec, {} candidates | "
+              "gating: {:.1f} games/hour, {} evaluated | buffer: {} samples | model version {}".format(
+              stats["games"] / hours, stats["samples"] / (hours * 3600.), stats["stale"],
+              stats["trained"] / max(stats["train_time"], EPS), stats["candidates"],
+              stats["arena_games"] / max(stats["arena_time"] / 3600., EPS), stats["gated"],
+              len(self.replayBuffer), self.modelVersion))
+        if self.broker is not None:
+            self.broker.report()
+
+
+    def keepEpisode(self, vs):
+        """
+        Decides whether the examples of an episode with values vs go into
+        training. Draws are dropped with probability args.filter_draw_rate.
+        """
+        if len(vs) == 0:
+            return False    # Every move of the game was a fast search
+        if abs(vs[0]) != 1:
+            return random.random() >= self.args.filter_draw_rate
+        return True
+
+
+    def arenaPlayer(self, mcts):
+        """
+        Returns a player for Arena that plays the most visited move of mcts
+        and reuses its subtree from one move to the next.
+        """
+        def play(board):
+            mcts.advanceRoot(board)
+            return np.argmax(mcts.getActionProb(board, temp=0))
+        return play
 
     def getCheckpointFile(self, iteration):
         return 'checkpoint_' + str(iteration) + '.pth.tar'
 
     def saveTrainExamples(self, iteration):
+        """
+        Moves the episodes of iteration, saved one by one while they came
+        in, into the replay store (at most maxlenOfQueue examples). Only the
+        new examples are written.
+
+        Returns:
+            added: the number of examples stored
+        """
+        print("Saving examples of iteration {} to {}".format(iteration, self.replay.folder))
+        return self.replay.commitPending(iteration, self.args.maxlenOfQueue)
+
+    def saveState(self, iteration, stage):
+        """
+        Records the stage ('selfplay', 'train' or 'arena') learn() is at, so
+        a crashed run restarts there with args.resume. The file is replaced
+        atomically.
+        """
         folder = self.args.checkpoint
         if not os.path.exists(folder):
             os.makedirs(folder)
+        path = os.path.join(folder, 'coach.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'iteration': iteration, 'stage': stage, 'modelVersion': self.modelVersion}, f)
+        os.replace(path + '.tmp', path)
 
-        filename = os.path.join(folder, self.getCheckpointFile(iteration)+".examples")
-        print("Saving examples: " + filename)
-        with open(filename, "wb+") as f:
-            Pickler(f).dump(self.trainExamplesHistory)
-        f.closed
+    def loadState(self):
+        """
+        Resumes the run in args.checkpoint where it stopped: the best model,
+        the iteration and stage learn() was at, and the episodes of that
+        iteration that were already played.
+        """
+        path = os.path.join(self.args.checkpoint, 'coach.json')
+        if not os.path.isfile(path):
+            print("No state in " + path + ", starting from scratch")
+            return
+        with open(path) as f:
+            state = json.load(f)
+        self.startIter = state['iteration']
+        self.resumeStage = state['stage']
+        self.modelVersion = state['modelVersion']
+        self.replayAdopted = True
+        if os.path.isfile(os.path.join(self.args.checkpoint, 'best.pth.tar')):
+            self.rolloutModel('best.pth.tar')
+        print("Resuming iteration {} at stage {} with model version {}".format(
+              self.startIter, self.resumeStage, self.modelVersion))
 
     def loadTrainExamples(self):
-        modelFile = os.path.join(self.args.load_folder_file[0], self.args.load_folder_file[1])
-        examplesFile = modelFile+".examples"
-        if not os.path.isfile(examplesFile):
-            print(examplesFile)
-            r = input("File with trainExamples not found. Continue? [y|n]")
-            if r != "y":
-                sys.exit()
-        else:
-            print("File with trainExamples found. Read it.")
+        """
+        Loads the replay store of the run in args.load_folder_file. Files
+        with pickled examples from older versions are imported into the
+        replay store. A store resumed by loadState() is kept as it is.
+        """
+        if self.replayAdopted:
+            print("Resumed replay store kept, not loading " + self.args.load_folder_file[0])
+            return
+        folder = self.args.load_folder_file[0]
+        store = ReplayBuffer(os.path.join(folder, 'replay'), self.args.numItersForTrainExamplesHistory)
+        examplesFile = os.path.join(folder, self.args.load_folder_file[1])+".examples"
+        if store.segments:
+            print("Replay store found. Read it.")
+            if store.folder != self.replay.folder:
+                self.replay.reset()
+                self.replay.copyFrom(store)
+            else:
+                self.replay = store
+        elif os.path.isfile(examplesFile):
+            print("File with trainExamples found. Importing it into the replay store.")
+            self.replay.reset()
             with open(examplesFile, "rb") as f:
-                self.trainExamplesHistory = Unpickler(f).load()
-            f.closed
-            # examples based on the model were already collected (loaded)
-            self.skipFirstSelfPlay = True
+                for iterationTrainExamples in Unpickler(f).load():
+                    self.replay.append(iterationTrainExamples)
+        else:
+            print("File with trainExamples not found: " + examplesFile + ", continuing without")
+            return
+        # examples based on the model were already collected (loaded)
+        self.replayAdopted = True
+        self.skipFirstSelfPlay = True
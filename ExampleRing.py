@@ -0,0 +1,91 @@
+import multiprocessing as mp
+import time
+import numpy as np
+
+
+class ExampleRing():
+    """
+    Fixed pool of example slots in shared memory, shared by every process
+    forked after it is created. Self-play workers write the examples of an
+    episode straight into free slots and only send the slot indices to the
+    master, which reads the examples out of the slots and releases them.
+
+    Every slot holds a board, a value and a sparse policy of at most
+    max_actions actions. A policy with more visited actions keeps its
+    max_actions most likely ones, renormalized.
+    """
+    def __init__(self, game, size, max_actions=256):
+        self.size = size
+        self.max_actions = min(max_actions, game.getActionSize())
+        board = np.asarray(game.getInitBoard())
+        dtype = np.dtype(board.dtype)
+
+        self.boards = np.frombuffer(mp.RawArray('b', size*board.size*dtype.itemsize), dtype=dtype).reshape((size,) + board.shape)
+        self.vs = np.frombuffer(mp.RawArray('f', size), dtype=np.float32)
+        self.counts = np.frombuffer(mp.RawArray('i', size), dtype=np.int32)
+        self.actions = np.frombuffer(mp.RawArray('i', size*self.max_actions), dtype=np.int32).reshape(size, self.max_actions)
+        self.probs = np.frombuffer(mp.RawArray('f', size*self.max_actions), dtype=np.float32).reshape(size, self.max_actions)
+
+        # 1 for the slots claimed by a worker and not released yet
+        self.used = np.frombuffer(mp.RawArray('b', size), dtype=np.int8)
+        self.lock = mp.Lock()
+
+    def claim(self, n):
+        """
+        Waits until n slots are free and claims them.
+
+        Returns:
+            slots: int array with the indices of the claimed slots
+        """
+        if n > self.size:
+            raise ValueError("Episode of {} examples does not fit in {} slots".format(n, self.size))
+        while True:
+            with self.lock:
+                free = np.flatnonzero(self.used == 0)[:n]
+                if len(free) == n:
+                    self.used[free] = 1
+                    return free
+            time.sleep(0.01)
+
+    def write(self, boards, pis, vs):
+        """
+        Writes the examples of an episode into free slots.
+
+        Input:
+            boards, pis, vs: the examples, as returned by Coach.executeEpisode
+
+        Returns:
+            slots: list with the slot of every example
+        """
+        slots = self.claim(len(vs))
+        for slot, board, (actions, probs), v in zip(slots, boards, pis, vs):
+            if len(actions) > self.max_actions:
+                top = np.argsort(-probs)[:self.max_actions]
+                actions, probs = actions[top], probs[top] / probs[top].sum()
+            self.boards[slot] = board
+            self.vs[slot] = v
+            self.counts[slot] = len(actions)
+            self.actions[slot, :len(actions)] = actions
+            self.probs[slot, :len(actions)] = probs
+        return slots.tolist()
+
+    def read(self, slots):
+        """
+        Copies the examples out of slots and releases them.
+
+        Returns:
+            boards, pis, vs: the examples in the format of
+                             Coach.executeEpisode
+        """
+        boards = self.boards[slots]
+        vs = self.vs[slots]
+        pis = [(self.actions[slot, :self.counts[slot]].copy(), self.probs[slot, :self.counts[slot]].copy())
+               for slot in slots]
+        self.release(slots)
+        return boards, pis, vs
+
+    def release(self, slots):
+        """
+        Frees slots without reading them.
+        """
+        self.used[slots] = 0
@@ -111,3 +111,24 @@ class Game():
                          Required by MCTS for hashing.
         """
         pass
+
+    def getHistoryMark(self):
+        """
+        Returns:
+            mark: a marker of the history the game keeps about the moves
+                  played so far (e.g. repetition counts in chess). MCTS takes
+                  a mark before each simulation and passes it to
+                  rollbackHistory afterwards.
+        """
+        return None
+
+    def rollbackHistory(self, mark):
+        """
+        Input:
+            mark: value returned by getHistoryMark
+
+        Undoes every change getNextState made to the move history since mark
+        was taken. Games whose rules do not depend on history need not
+        override this.
+        """
+        pass
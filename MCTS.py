@@ -3,10 +3,22 @@ import numpy as np
 from chess.ChessUtil import decode_move, algebraic
 from chess.ChessGame import display
 import sys
-import copy
-from random import shuffle
+import time
+from random import choice
+from NodeTable import NodeTable
 EPS = 1e-8
 
+
+def argmax_tiebreak(u):
+    """
+    Index of the largest entry of u. Ties are broken uniformly at random,
+    which is the same distribution as shuffling the actions and keeping the
+    first one with the strictly largest value.
+    """
+    best = np.flatnonzero(u == u.max())
+    return best[0] if len(best) == 1 else choice(best)
+
+
 class MCTS():
     """
     This class handles the MCTS tree.
@@ -19,27 +31,122 @@ class MCTS():
         self.Qsa = {}       # stores Q values for s,a (as defined in the paper)
         self.Nsa = {}       # stores #times edge s,a was visited
         self.Ns = {}        # stores #times board s was visited
-        self.Ps = {}        # stores initial policy (returned by neural net)
+        self.Ps = {}        # stores initial policy of the valid moves (returned by neural net)
 
         self.Es = {}        # stores game.getGameEnded ended for board s
-        self.Vs = {}        # stores game.getValidMoves for board s
+        self.As = {}        # stores indices of the valid moves for board s
+
+        # args.nodeTable replaces the dicts above with an array-backed table
+        # that only stores the legal actions of every expanded board
+        self.nodeTable = args.get('nodeTable', False)
+
+        self.nodesVisited = 0   # boards visited by the current getActionProb
+        self.searchStats = {}   # statistics of the last getActionProb, see there
+
+        # args.maxNodes and args.maxNodeBytes cap the size of the NodeTable,
+        # cold nodes are evicted between simulations (see NodeTable.evict)
+        self.nodes = NodeTable(args.get('maxNodes'), args.get('maxNodeBytes'))
+
+        # args.searchBatchSize > 1 evaluates that many leaves per nnet call,
+        # see collectBatch()
+        self.batchSize = args.get('searchBatchSize', 1)
 
-    def getActionProb(self, canonicalBoard, temp=1):
+        # args.topKMoves turns on progressive widening, see admitted().
+        # Batched, bounded and widened search are only implemented on the
+        # NodeTable, so they always use it; plain search keeps the dicts
+        # unless args.nodeTable is set
+        self.topK = args.get('topKMoves', 0)
+        self.wideningExponent = args.get('wideningExponent', 0.5)
+
+        if self.batchSize > 1 or self.topK > 0 or self.nodes.max_nodes is not None or self.nodes.max_bytes is not None:
+            self.nodeTable = True
+
+    def getActionProb(self, canonicalBoard, temp=1, sims=None, noise=False, deadline=None, nodes=None):
         """
         This function performs numMCTSSims simulations of MCTS starting from
-        canonicalBoard.
+        canonicalBoard, or sims simulations if given.
+
+        Instead of (or on top of) a simulation count, the search can be
+        bounded by a wall-clock deadline (a time.time() value) and/or a
+        budget of nodes, i.e. boards visited by the simulations; it stops at
+        the first limit reached. With temp=0 it also stops as soon as the
+        most visited move can no longer be overtaken within the remaining
+        budget. Statistics of the search are left in self.searchStats.
+
+        With noise, Dirichlet noise (args.dirichletAlpha, args.dirichletEpsilon)
+        is mixed into the priors of the root for this search only. It is a
+        no-op if args.dirichletAlpha is not set.
 
         Returns:
             probs: a policy vector where the probability of the ith action is
                    proportional to Nsa[(s,a)]**(1./temp)
         """
-        for i in range(self.args.numMCTSSims):
-            tmp_game = copy.deepcopy(self.game)
-            self.search(canonicalBoard)
-            self.game = tmp_game
+        steps = self.searchSteps(canonicalBoard, temp, sims, noise, deadline, nodes)
+        try:
+            boards = next(steps)
+            while True:
+                boards = steps.send(self.nnet.predict_batch(boards))
+        except StopIteration as stop:
+            return stop.value
 
+
+    def searchSteps(self, canonicalBoard, temp=1, sims=None, noise=False, deadline=None, nodes=None):
+        """
+        The search of getActionProb() as a generator, so the leaves of many
+        searches can be evaluated together (see Coach.lockstepWorker). With
+        args.searchBatchSize > 1 it yields the boards of every batch of
+        leaves instead of calling the nnet, and expects the (pis, vs) of
+        nnet.predict_batch to be sent back; other modes never yield.
+
+        Returns (as the value of StopIteration):
+            probs: the result of getActionProb()
+        """
         s = self.game.stringRepresentation(canonicalBoard)
-        counts = [self.Nsa[(s,a)] if (s,a) in self.Nsa else 0 for a in range(self.game.getActionSize())]
+        if sims is None and deadline is None and nodes is None:
+            sims = self.args.numMCTSSims
+        noise = noise and self.args.get('dirichletAlpha') is not None
+        root_priors = None
+
+        start = time.time()
+        self.nodesVisited = 0
+        depth = 0
+        done = 0
+        search = self.searchNodes if self.nodeTable else self.search
+        mark = self.game.getHistoryMark()
+        while True:
+            stopped = self.stopReason(s, temp, start, done, sims, deadline, nodes)
+            if stopped is not None:
+                break
+
+            visited = self.nodesVisited
+            if self.batchSize > 1:
+                batch = self.collectBatch(canonicalBoard, self.batchSize if sims is None else min(self.batchSize, sims - done))
+                pis, vs = (yield np.array(list(batch[1].values()))) if batch[1] else (None, None)
+                done += self.backupBatch(batch, pis, vs)
+                depth = max(depth, self.batchDepth)
+            else:
+                search(canonicalBoard)
+                self.game.rollbackHistory(mark)    # undo the moves made by the simulation
+                done += 1
+                depth = max(depth, self.nodesVisited - visited)
+            if self.nodeTable:
+                self.evictNodes(s)
+
+            # the root is expanded by the first simulation
+            if noise and root_priors is None:
+                root_priors = self.addRootNoise(s)
+
+        if root_priors is not None:
+            self.setRootPriors(s, root_priors)
+
+        elapsed = time.time() - start
+        self.searchStats = {'sims': done, 'nodes': self.nodesVisited, 'depth': depth, 'time': elapsed,
+                            'nodes/sec': self.nodesVisited / max(elapsed, EPS), 'stopped': stopped}
+
+        if self.nodeTable:
+            counts = self.nodes.counts(s, self.game.getActionSize())
+        else:
+            counts = [self.Nsa[(s,a)] if (s,a) in self.Nsa else 0 for a in range(self.game.getActionSize())]
         #print("**********************************")
         #x= list(np.where(np.array(counts) > 0)[0])
         #tmp_map = map(decode_move, x)
@@ -58,6 +165,111 @@ class MCTS():
         return probs
 
 
+    def advanceRoot(self, canonicalBoard):
+        """
+        Makes canonicalBoard the root of the tree. Call this with the board
+        the game actually reached before asking for the next move: the
+        subtree below it keeps all of its visit counts, so the next
+        getActionProb builds on it, and every node that can no longer be
+        reached from it is freed.
+
+        Only the NodeTable records the child links this needs; with the
+        dicts the tree is left as it is.
+
+        Returns:
+            freed: the number of nodes removed
+        """
+        if not self.nodeTable:
+            return 0
+
+        root = self.nodes.lookup(self.game.stringRepresentation(canonicalBoard))
+        return self.nodes.prune(root)
+
+
+    def stopReason(self, s, temp, start, done, sims, deadline, nodes):
+        """
+        Returns:
+            reason: None if the search of getActionProb should go on, else
+                    why it stops ('sims', 'deadline', 'nodes' or 'decided')
+        """
+        if sims is not None and done >= sims:
+            return 'sims'
+        if done == 0:
+            return None     # at least one simulation, so the root is expanded
+        if deadline is not None and time.time() >= deadline:
+            return 'deadline'
+        if nodes is not None and self.nodesVisited >= nodes:
+            return 'nodes'
+
+        if temp == 0:
+            # estimate how many more simulations the budget allows
+            remaining = float('inf') if sims is None else sims - done
+            if deadline is not None:
+                remaining = min(remaining, done*(deadline - time.time())/max(time.time() - start, EPS))
+            if nodes is not None:
+                remaining = min(remaining, done*(nodes - self.nodesVisited)/max(self.nodesVisited, 1))
+
+            counts = self.rootCounts(s)
+            if len(counts) > 1:
+                second, best = np.partition(counts, -2)[-2:]
+                if best - second > remaining:
+                    return 'decided'
+        return None
+
+
+    def rootCounts(self, s):
+        """
+        Returns:
+            counts: array with the visit counts of the valid moves of board s
+        """
+        if self.nodeTable:
+            node = self.nodes.ids.get(s)
+            return self.nodes.visits(node) if node is not None else np.zeros(0)
+        return np.array([self.Nsa.get((s,a), 0) for a in self.As.get(s, [])])
+
+
+    def addRootNoise(self, s):
+        """
+        Mixes Dirichlet noise into the priors of the valid moves of the root s.
+
+        Returns:
+            priors: the priors of s before the noise, to be put back with
+                    setRootPriors() once the search is done
+        """
+        alpha = self.args.dirichletAlpha
+        eps = self.args.get('dirichletEpsilon', 0.25)
+        if self.nodeTable:
+            node = self.nodes.ids.get(s)
+            if node is None:
+                return None
+            priors = self.nodes.Ps[node]
+        else:
+            if s not in self.Ps:
+                return None
+            priors = self.Ps[s]
+
+        noise = np.random.dirichlet([alpha]*len(priors))
+        self.setRootPriors(s, ((1 - eps)*priors + eps*noise).astype(np.float32))
+        return priors
+
+
+    def setRootPriors(self, s, priors):
+        if self.nodeTable:
+            self.nodes.Ps[self.nodes.ids[s]] = priors
+        else:
+            self.Ps[s] = priors
+
+
+    def evictNodes(self, s):
+        """
+        Brings the NodeTable back under its cap if needed. The principal
+        variation from the root s is never evicted.
+        """
+        if self.nodes.full():
+            root = self.nodes.ids.get(s)
+            self.nodes.evict(set(self.nodes.principalVariation(root)))
+
+
     def search(self, canonicalBoard):
         """
         This function performs one iteration of MCTS. It is recursively called
@@ -80,6 +292,7 @@ class MCTS():
         # print("SEARCH")
 
         s = self.game.stringRepresentation(canonicalBoard)
+        self.nodesVisited += 1
 
         game_end_score = self.game.getGameEnded(canonicalBoard, 1)
         if game_end_score != 0:
@@ -95,47 +308,20 @@ class MCTS():
 
         if s not in self.Ps:
             # leaf node
-            self.Ps[s], v = self.nnet.predict(canonicalBoard)
-            valids = self.game.getValidMoves(canonicalBoard, 1)
-            self.Ps[s] = self.Ps[s]*valids      # masking invalid moves
-            sum_Ps_s = np.sum(self.Ps[s])
-            if sum_Ps_s > 0:
-                self.Ps[s] /= sum_Ps_s    # renormalize
-            else:
-                # if all valid moves were masked make all valid moves equally probable
-                
-                # NB! All valid moves may be masked if either your NNet architecture is insufficient or you've get overfitting or something else.
-                # If you have got dozens or hundreds of these messages you should pay attention to your NNet and/or training process.   
-                print("All valid moves were masked, do workaround.")
-                self.Ps[s] = self.Ps[s] + valids
-                self.Ps[s] /= np.sum(self.Ps[s])
-
-            self.Vs[s] = valids
+            pi, v = self.nnet.predict(canonicalBoard)
+            self.As[s], self.Ps[s] = self.validPriors(canonicalBoard, pi)
             self.Ns[s] = 0
-            return -v
-
-        valids = self.Vs[s]
-        cur_best = -float('inf')
-        best_act = -1
-
-        # pick the action with the highest upper confidence bound
-        all_actions = list(range(self.game.getActionSize()))
-        shuffle(all_actions)
-        for a in all_actions:
-            if valids[a]:
-                if (s,a) in self.Qsa:
-                    u = self.Qsa[(s,a)] + self.args.cpuct*self.Ps[s][a]*math.sqrt(self.Ns[s])/(1+self.Nsa[(s,a)])
-                else:
-                    u = self.args.cpuct*self.Ps[s][a]*math.sqrt(self.Ns[s] + EPS)     # Q = 0 ?
-
-                if u > cur_best:
-                    cur_best = u
-                    best_act = a
-
-        a = best_act
-        
-        where = np.where(valids==1)
-        testing = list(map(decode_move, list(np.where(valids==1))[0]))
+            return -np.asarray(v).item()
+
+        # pick the action with the highest upper confidence bound, only the
+        # valid moves are scored
+        actions = self.As[s]
+        Nsa = np.array([self.Nsa.get((s,a), 0) for a in actions])
+        Qsa = np.array([self.Qsa.get((s,a), 0) for a in actions], dtype=np.float64)     # Q = 0 ?
+        sqrt_Ns = np.where(Nsa > 0, math.sqrt(self.Ns[s]), math.sqrt(self.Ns[s] + EPS))
+        u = Qsa + self.args.cpuct*self.Ps[s]*sqrt_Ns/(1 + Nsa)
+        a = actions[argmax_tiebreak(u)]
+
         next_s, next_player = self.game.getNextState(canonicalBoard, 1, a)
         next_s = self.game.getCanonicalForm(next_s, next_player)
         # print("SEARCHing again...")
@@ -151,3 +337,220 @@ class MCTS():
 
         self.Ns[s] += 1
         return -v
+
+
+    def searchNodes(self, canonicalBoard, parent=None):
+        """
+        Same as search(), but the statistics are kept in self.nodes. Each
+        expanded board stores only its legal actions, so picking the action
+        with the highest upper confidence bound is a single argmax.
+
+        parent is the (node, i) edge that led to canonicalBoard; the child
+        link is recorded on it so advanceRoot() can tell which nodes are
+        still reachable.
+
+        Returns:
+            v: the negative of the value of the current canonicalBoard
+        """
+        s = self.game.stringRepresentation(canonicalBoard)
+        self.nodesVisited += 1
+
+        game_end_score = self.game.getGameEnded(canonicalBoard, 1)
+        if game_end_score != 0:
+            return -game_end_score
+
+        node = self.nodes.lookup(s)
+        if node is None:
+            # leaf node
+            pi, v = self.nnet.predict(canonicalBoard)
+            node = self.expandNode(canonicalBoard, s, pi)
+            if parent is not None:
+                self.nodes.link(parent[0], parent[1], node)
+            return -np.asarray(v).item()
+
+        if parent is not None:
+            self.nodes.link(parent[0], parent[1], node)
+
+        i = self.selectNode(node)
+        a = self.nodes.actions[node][i]
+
+        next_s, next_player = self.game.getNextState(canonicalBoard, 1, a)
+        next_s = self.game.getCanonicalForm(next_s, next_player)
+        v = self.searchNodes(next_s, (node, i))
+
+        self.nodes.update(node, i, v)
+        return -v
+
+
+    def collectBatch(self, canonicalBoard, k):
+        """
+        Descends up to k simulations whose leaves are then evaluated together
+        with one nnet.predict_batch call, see backupBatch(). The k paths are
+        descended one after another from canonicalBoard; every edge on a
+        pending path carries a virtual loss so that the following paths
+        spread out over the tree instead of all reaching the same leaf.
+
+        A path that still ends on a leaf already claimed by another path of
+        the batch is dropped, so fewer than k simulations may be done. The
+        length of the deepest path is left in self.batchDepth.
+
+        Returns:
+            batch: (paths, leaves) where leaves maps every leaf s that needs
+                   the nnet to its board
+        """
+        vloss = {}          # stores virtual loss counts of the legal actions of a node
+        paths = []          # stores (path, s, board, value) for every simulation
+        leaves = {}         # stores board for every leaf s that needs the nnet
+
+        mark = self.game.getHistoryMark()
+        self.batchDepth = 0
+        for _ in range(k):
+            path = []
+            board = canonicalBoard
+            while True:
+                s = self.game.stringRepresentation(board)
+                self.nodesVisited += 1
+
+                game_end_score = self.game.getGameEnded(board, 1)
+                if game_end_score != 0:
+                    value = -game_end_score
+                    break
+
+                node = self.nodes.lookup(s)
+                if node is None:
+                    # leaf node
+                    value = None
+                    break
+                if path:
+                    self.nodes.link(path[-1][0], path[-1][1], node)
+
+                i = self.selectNode(node, vloss.get(node))
+                if node not in vloss:
+                    vloss[node] = np.zeros(len(self.nodes.actions[node]), dtype=np.int32)
+                vloss[node][i] += 1
+                path.append((node, i))
+
+                next_s, next_player = self.game.getNextState(board, 1, self.nodes.actions[node][i])
+                board = self.game.getCanonicalForm(next_s, next_player)
+            self.game.rollbackHistory(mark)
+            self.batchDepth = max(self.batchDepth, len(path) + 1)
+
+            if value is None:
+                if s in leaves:
+                    # collision, another path of this batch expands s
+                    for node, i in path:
+                        vloss[node][i] -= 1
+                    continue
+                leaves[s] = board
+            paths.append((path, s, value))
+
+        return paths, leaves
+
+
+    def backupBatch(self, batch, pis, vs):
+        """
+        Expands the leaves of a batch from collectBatch() with the policies
+        pis and values vs the nnet returned for them (in the order of the
+        leaves), and backs up every simulation of the batch.
+
+        Returns:
+            sims: the number of simulations backed up
+        """
+        paths, leaves = batch
+        values = {}
+        if leaves:
+            for (s, board), pi, v in zip(leaves.items(), pis, vs):
+                self.expandNode(board, s, pi)
+                values[s] = -np.asarray(v).item()
+
+        for path, s, value in paths:
+            if value is None and path:
+                self.nodes.link(path[-1][0], path[-1][1], self.nodes.lookup(s))
+            v = values[s] if value is None else value
+            for node, i in reversed(path):
+                self.nodes.update(node, i, v)
+                v = -v
+
+        return len(paths)
+
+
+    def validPriors(self, canonicalBoard, pi):
+        """
+        Restricts the policy pi of the neural network to the valid moves of
+        canonicalBoard and renormalizes it.
+
+        Returns:
+            actions: indices of the valid moves
+            priors: policy of the valid moves, aligned with actions
+        """
+        valids = self.game.getValidMoves(canonicalBoard, 1)
+        actions = np.flatnonzero(valids).astype(np.int32)
+        priors = np.asarray(pi, dtype=np.float32)[actions]
+        sum_Ps_s = np.sum(priors)
+        if sum_Ps_s > 0:
+            priors /= sum_Ps_s    # renormalize
+        else:
+            # if all valid moves were masked make all valid moves equally probable
+
+            # NB! All valid moves may be masked if either your NNet architecture is insufficient or you've get overfitting or something else.
+            # If you have got dozens or hundreds of these messages you should pay attention to your NNet and/or training process.
+            print("All valid moves were masked, do workaround.")
+            priors = np.full(len(actions), 1./len(actions), dtype=np.float32)
+
+        return actions, priors
+
+
+    def expandNode(self, canonicalBoard, s, pi):
+        """
+        Adds board s to self.nodes with the policy pi of the neural network
+        restricted to the valid moves. With progressive widening the moves
+        are stored by decreasing prior, and statistics are only kept for
+        the admitted ones, see admitted().
+        """
+        actions, priors = self.validPriors(canonicalBoard, pi)
+        if self.topK > 0:
+            order = np.argsort(-priors, kind='stable')
+            actions, priors = actions[order], priors[order]
+            return self.nodes.add(s, actions, priors, width=self.topK)
+
+        return self.nodes.add(s, actions, priors)
+
+
+    def admitted(self, node):
+        """
+        Progressive widening: with args.topKMoves = k > 0 only the k moves
+        with the highest prior are searched at first, and a node visited Ns
+        times admits k + Ns**args.wideningExponent of them.
+
+        Returns:
+            m: the number of moves of node, by decreasing prior, that
+               selectNode() may pick
+        """
+        n = len(self.nodes.actions[node])
+        if self.topK <= 0:
+            return n
+        return min(n, self.topK + int(self.nodes.Ns[node]**self.wideningExponent))
+
+
+    def selectNode(self, node, vloss=None):
+        """
+        Picks the legal action of node with the highest upper confidence
+        bound. vloss holds the virtual losses of pending simulations; each
+        one counts as a visit that lost.
+
+        Returns:
+            i: the position of the action in self.nodes.actions[node]
+        """
+        m = self.admitted(node)
+        self.nodes.widen(node, m)
+        Qsa = self.nodes.Qsa[node][:m]
+        Nsa = self.nodes.Nsa[node][:m]
+        Ns = self.nodes.Ns[node]
+        if vloss is not None:
+            vloss = vloss[:m]
+            Qsa = np.where(Nsa + vloss > 0, (Nsa*Qsa - vloss)/np.maximum(Nsa + vloss, 1), 0)
+            Nsa = Nsa + vloss
+            Ns = Ns + int(vloss.sum())
+
+        u = Qsa + self.args.cpuct*self.nodes.Ps[node][:m]*math.sqrt(Ns + EPS)/(1 + Nsa)
+        return argmax_tiebreak(u)
@@ -1,3 +1,5 @@
+import numpy as np
+
 class NeuralNet():
     """
     This class specifies the base NeuralNet class. To define your own neural
@@ -36,6 +38,22 @@ class NeuralNet():
         """
         pass
 
+    def predict_batch(self, boards):
+        """
+        Input:
+            boards: numpy array of boards in their canonical form, stacked
+                    along the first axis.
+
+        Returns:
+            pis: array of policy vectors, one row per board
+            vs: array of values, one per board
+
+        Override this to evaluate all boards in a single forward pass; the
+        default calls predict() on every board.
+        """
+        pis, vs = zip(*[self.predict(board) for board in boards])
+        return np.array(pis), np.array(vs)
+
     def save_checkpoint(self, folder, filename):
         """
         Saves the current neural network (with its parameters) in
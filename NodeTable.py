@@ -0,0 +1,268 @@
+import numpy as np
+
+NODE_OVERHEAD = 750     # approximate bytes of python objects per node, besides its arrays and key
+EVICT_TO = 0.9          # evict() frees nodes until the table is at this fraction of its cap
+
+
+class NodeTable():
+    """
+    Array-backed storage for the MCTS tree. Every expanded board s gets one
+    integer node id, and the statistics of its legal actions live in small
+    contiguous numpy arrays indexed by that id. Only the legal actions are
+    stored, so a chess node holds a few dozen entries instead of 4353.
+    A node added with a width keeps the statistics (Nsa, Qsa, children) of
+    its first width actions only, widen() makes room for more; the actions
+    and their priors are always stored in full.
+
+    The table is a transposition table: boards reached along different paths
+    share a node. It can be capped to max_nodes nodes and/or max_bytes bytes,
+    in which case evict() drops the coldest nodes, least recently used first
+    and least visited among those.
+    """
+
+    def __init__(self, max_nodes=None, max_bytes=None):
+        self.ids = {}           # stores node id for board s
+        self.actions = []       # stores legal action indices of each node
+        self.Ps = []            # stores priors of the legal actions (returned by neural net)
+        self.Nsa = []           # stores #times each legal action of a node was taken
+        self.Qsa = []           # stores Q values of the legal actions of a node
+        self.Ns = []            # stores #times each node was visited
+        self.children = []      # stores node id reached by each legal action of a node (-1 if unknown)
+        self.lastUsed = []      # stores clock value of the last lookup of each node
+        self.free = []          # stores ids of removed nodes, reused by add()
+
+        self.max_nodes = max_nodes
+        self.max_bytes = max_bytes
+        self.bytes = 0          # approximate memory held by the nodes
+        self.clock = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, s):
+        return s in self.ids
+
+    def lookup(self, s):
+        """
+        Returns:
+            node: the node id of board s, or None if s was never expanded
+                  (or was evicted)
+        """
+        node = self.ids.get(s)
+        if node is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.clock += 1
+            self.lastUsed[node] = self.clock
+        return node
+
+    def add(self, s, actions, priors, width=None):
+        """
+        Expands board s.
+
+        Input:
+            s: string representation of the board
+            actions: integer array with the indices of the legal actions
+            priors: policy of the legal actions, aligned with actions
+            width: number of actions to keep statistics for, all if None
+
+        Returns:
+            node: the node id of s
+        """
+        n = len(actions) if width is None else min(width, len(actions))
+        if self.free:
+            node = self.free.pop()
+            self.actions[node] = actions
+            self.Ps[node] = priors
+            self.Nsa[node] = np.zeros(n, dtype=np.int32)
+            self.Qsa[node] = np.zeros(n, dtype=np.float32)
+            self.Ns[node] = 0
+            self.children[node] = np.full(n, -1, dtype=np.int32)
+            self.lastUsed[node] = 0
+        else:
+            node = len(self.actions)
+            self.actions.append(actions)
+            self.Ps.append(priors)
+            self.Nsa.append(np.zeros(n, dtype=np.int32))
+            self.Qsa.append(np.zeros(n, dtype=np.float32))
+            self.Ns.append(0)
+            self.children.append(np.full(n, -1, dtype=np.int32))
+            self.lastUsed.append(0)
+
+        self.ids[s] = node
+        self.clock += 1
+        self.lastUsed[node] = self.clock
+        self.bytes += self.nodeBytes(s, node)
+        return node
+
+    def widen(self, node, m):
+        """
+        Makes room for the statistics of the first m actions of node.
+        """
+        n = len(self.Nsa[node])
+        m = min(m, len(self.actions[node]))
+        if m <= n:
+            return
+        self.Nsa[node] = np.concatenate([self.Nsa[node], np.zeros(m - n, dtype=np.int32)])
+        self.Qsa[node] = np.concatenate([self.Qsa[node], np.zeros(m - n, dtype=np.float32)])
+        self.children[node] = np.concatenate([self.children[node], np.full(m - n, -1, dtype=np.int32)])
+        self.bytes += (m - n) * (4 + 4 + 4)
+
+    def visits(self, node):
+        """
+        Returns:
+            counts: the visit counts of all the legal actions of node,
+                    aligned with self.actions[node]
+        """
+        counts = np.zeros(len(self.actions[node]), dtype=np.int32)
+        counts[:len(self.Nsa[node])] = self.Nsa[node]
+        return counts
+
+    def remove(self, s):
+        """
+        Drops board s from the table and releases its node id.
+        """
+        node = self.ids.pop(s)
+        self.bytes -= self.nodeBytes(s, node)
+        self.actions[node] = None
+        self.Ps[node] = None
+        self.Nsa[node] = None
+        self.Qsa[node] = None
+        self.children[node] = None
+        self.free.append(node)
+
+    def nodeBytes(self, s, node):
+        """
+        Returns:
+            bytes: approximate memory held by node, its arrays and its key s
+        """
+        arrays = (self.actions[node], self.Ps[node], self.Nsa[node], self.Qsa[node], self.children[node])
+        return len(s) + sum(a.nbytes for a in arrays) + NODE_OVERHEAD
+
+    def full(self):
+        """
+        Returns:
+            full: True if the table is over one of its caps
+        """
+        return (self.max_nodes is not None and len(self.ids) > self.max_nodes) or \
+               (self.max_bytes is not None and self.bytes > self.max_bytes)
+
+    def evict(self, protect=()):
+        """
+        If the table is over its cap, removes the coldest nodes until it is
+        back to EVICT_TO of the cap. Nodes in protect are never removed.
+        Child links to evicted nodes are cleared, so an evicted board is
+        simply expanded again the next time the search reaches it.
+
+        Returns:
+            evicted: the number of nodes removed
+        """
+        if not self.full():
+            return 0
+
+        max_nodes = EVICT_TO*self.max_nodes if self.max_nodes is not None else float('inf')
+        max_bytes = EVICT_TO*self.max_bytes if self.max_bytes is not None else float('inf')
+
+        cold = sorted((s for s, node in self.ids.items() if node not in protect),
+                      key=lambda s: (self.lastUsed[self.ids[s]], self.Ns[self.ids[s]]))
+        dead = np.zeros(len(self.actions), dtype=bool)
+        evicted = 0
+        for s in cold:
+            if len(self.ids) <= max_nodes and self.bytes <= max_bytes:
+                break
+            dead[self.ids[s]] = True
+            self.remove(s)
+            evicted += 1
+
+        for node in self.ids.values():
+            children = self.children[node]
+            children[(children >= 0) & dead[children]] = -1
+
+        self.evictions += evicted
+        return evicted
+
+    def principalVariation(self, root):
+        """
+        Returns:
+            nodes: list of node ids found by following the most visited
+                   action from root, root included
+        """
+        pv = []
+        node = root
+        while node is not None and node >= 0 and node not in pv:
+            pv.append(node)
+            if self.Ns[node] == 0:
+                break
+            node = int(self.children[node][np.argmax(self.Nsa[node])])
+        return pv
+
+    def stats(self):
+        """
+        Returns:
+            stats: dict with the size of the table and its hit, miss and
+                   eviction counters
+        """
+        return {'nodes': len(self.ids), 'bytes': self.bytes, 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions}
+
+    def link(self, node, i, child):
+        """
+        Records that the i-th legal action of node leads to node child.
+        """
+        self.children[node][i] = child
+
+    def reachable(self, root):
+        """
+        Returns:
+            nodes: set of the node ids reachable from root through the
+                   recorded child links, root included
+        """
+        seen = set()
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            if node in seen:
+                continue
+            seen.add(node)
+            children = self.children[node]
+            stack.extend(children[children >= 0].tolist())
+        return seen
+
+    def prune(self, root):
+        """
+        Frees every node that cannot be reached from root. If root is None
+        the whole table is cleared.
+
+        Returns:
+            freed: the number of nodes removed
+        """
+        keep = self.reachable(root) if root is not None else set()
+        dead = [s for s, node in self.ids.items() if node not in keep]
+        for s in dead:
+            self.remove(s)
+        return len(dead)
+
+    def counts(self, s, action_size):
+        """
+        Returns:
+            counts: dense list of length action_size with the visit count of
+                    every action of board s (0 if s was never expanded)
+        """
+        counts = np.zeros(action_size, dtype=np.int64)
+        node = self.ids.get(s)
+        if node is not None:
+            counts[self.actions[node]] = self.visits(node)
+        return counts.tolist()
+
+    def update(self, node, i, v):
+        """
+        Backs up value v through the i-th legal action of node.
+        """
+        n = self.Nsa[node][i]
+        self.Qsa[node][i] = (n*self.Qsa[node][i] + v)/(n+1)
+        self.Nsa[node][i] = n + 1
+        self.Ns[node] += 1
@@ -0,0 +1,316 @@
+import json
+import os
+import queue
+import threading
+import numpy as np
+from utils import sparse_policy, dense_policies
+
+MANIFEST = 'manifest.json'
+FIELDS = ['boards', 'values', 'indptr', 'actions', 'probs']
+
+
+class ReplayBuffer():
+    """
+    On-disk store of self-play examples, one segment per iteration.
+
+    A segment holds fixed-dtype numpy arrays saved with np.save:
+        boards   (n, *boardSize) with the dtype of the boards
+        values   (n,) float32
+        indptr   (n+1,) int64, example j owns entries indptr[j]:indptr[j+1]
+        actions  int32, the actions with a non-zero probability
+        probs    float16, their probability
+
+    so a chess policy costs a few dozen entries instead of 4353 floats.
+    Segments are memory-mapped when read. The manifest lists the window
+    newest segments and is replaced atomically; appending an iteration
+    writes the new segment and the manifest and never rewrites the older
+    segments.
+    """
+    def __init__(self, folder, window):
+        self.folder = folder
+        self.window = window
+        self.segments = []      # stores names of the segments in the window, oldest first
+        self.next = 0           # stores number of the next segment
+        self.mmaps = {}         # stores memory-mapped arrays of each segment
+        self.committed = None   # stores tag of the last pending episodes moved into a segment
+
+        path = os.path.join(folder, MANIFEST)
+        if os.path.isfile(path):
+            with open(path) as f:
+                manifest = json.load(f)
+            self.segments = manifest['segments']
+            self.next = manifest['next']
+            self.committed = manifest.get('committed')
+
+    def __getstate__(self):
+        # the memory maps are reopened by the receiving process
+        state = self.__dict__.copy()
+        state['mmaps'] = {}
+        return state
+
+    def __len__(self):
+        return sum(len(self.segment(name)['values']) for name in self.segments)
+
+    def append(self, examples):
+        """
+        Writes the examples of one iteration as a new segment and drops the
+        oldest segments that fall out of the window.
+
+        Input:
+            examples: iterable of (board, pi, v), pi either sparse
+                      (actions, probs) or dense
+        """
+        examples = list(examples)
+        if not examples:
+            return
+        self.addSegment(self.toArrays(examples))
+
+    def toArrays(self, examples):
+        """
+        Returns:
+            arrays: dict with the arrays of a segment holding examples
+        """
+        boards, pis, vs = list(zip(*examples))
+        pis = [pi if isinstance(pi, tuple) else sparse_policy(pi) for pi in pis]
+        indptr = np.zeros(len(pis) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum([len(actions) for actions, _ in pis])
+        return {'boards': np.asarray(boards),
+                'values': np.asarray(vs, dtype=np.float32).reshape(-1),
+                'indptr': indptr,
+                'actions': np.concatenate([actions for actions, _ in pis]).astype(np.int32),
+                'probs': np.concatenate([probs for _, probs in pis]).astype(np.float16)}
+
+    def addSegment(self, arrays):
+        """
+        Saves arrays as the newest segment, then drops the oldest segments
+        that fall out of the window.
+        """
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+        name = 'segment_' + str(self.next)
+        for key in FIELDS:
+            np.save(os.path.join(self.folder, name + '.' + key + '.npy'), np.asarray(arrays[key]))
+        self.segments.append(name)
+        self.next += 1
+
+        dropped = self.segments[:-self.window] if len(self.segments) > self.window else []
+        self.segments = self.segments[len(dropped):]
+        self.saveManifest()
+        for name in dropped:
+            self.deleteSegment(name)
+
+    def saveManifest(self):
+        """
+        Replaces the manifest, so a crash leaves either the old or the new one.
+        """
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+        path = os.path.join(self.folder, MANIFEST)
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'segments': self.segments, 'next': self.next, 'committed': self.committed}, f)
+        os.replace(path + '.tmp', path)
+
+    def reset(self):
+        """
+        Empties the store and deletes the segments of its window, e.g. the
+        ones an earlier run left in the folder when it is not resumed.
+        """
+        for name in self.segments:
+            self.deleteSegment(name)
+        self.segments = []
+        self.next = 0
+        self.mmaps = {}
+        self.committed = None
+        self.clearPending()
+        if os.path.isfile(os.path.join(self.folder, MANIFEST)):
+            self.saveManifest()
+
+    def deleteSegment(self, name):
+        self.mmaps.pop(name, None)
+        for key in FIELDS:
+            path = os.path.join(self.folder, name + '.' + key + '.npy')
+            if os.path.isfile(path):
+                os.remove(path)
+
+    def segment(self, name):
+        """
+        Returns:
+            arrays: dict with the memory-mapped arrays of segment name
+        """
+        if name not in self.mmaps:
+            self.mmaps[name] = {key: np.load(os.path.join(self.folder, name + '.' + key + '.npy'), mmap_mode='r')
+                                for key in FIELDS}
+        return self.mmaps[name]
+
+    def examples(self):
+        """
+        Returns:
+            examples: list of (board, pi, v) of every segment in the window,
+                      pi as a sparse (actions, probs) pair
+        """
+        examples = []
+        for name in self.segments:
+            seg = self.segment(name)
+            split = seg['indptr'][1:-1]
+            actions = np.split(np.asarray(seg['actions']), split)
+            probs = np.split(np.asarray(seg['probs'], dtype=np.float32), split)
+            examples += zip(np.asarray(seg['boards']), zip(actions, probs), np.asarray(seg['values']))
+        return examples
+
+    def copyFrom(self, other):
+        """
+        Appends every segment in the window of other, e.g. the store of the
+        run being resumed.
+        """
+        for name in other.segments:
+            self.addSegment(other.segment(name))
+
+    def steps(self, batch_size):
+        """
+        Returns:
+            steps: the number of minibatches of batch_size in one epoch
+        """
+        return -(-len(self) // batch_size)
+
+    def batch(self, index, sizes, action_size):
+        """
+        Returns:
+            boards, pis, vs: the examples with the global indices index (one
+                             numbering over the segments of the window, in
+                             order), pis densified to action_size
+        """
+        starts = np.cumsum(sizes) - sizes
+        owners = np.searchsorted(starts, index, side='right') - 1
+        boards, pis, vs = [None]*len(index), [None]*len(index), np.zeros(len(index), dtype=np.float32)
+        for k in np.unique(owners):
+            seg = self.segment(self.segments[k])
+            pos = np.flatnonzero(owners == k)
+            rows = index[pos] - starts[k]
+            segBoards = seg['boards'][rows]
+            vs[pos] = seg['values'][rows]
+            for j, row, board in zip(pos, rows, segBoards):
+                lo, hi = seg['indptr'][row], seg['indptr'][row+1]
+                boards[j] = board
+                pis[j] = (np.asarray(seg['actions'][lo:hi]), np.asarray(seg['probs'][lo:hi], dtype=np.float32))
+        return np.asarray(boards), dense_policies(pis, action_size), vs
+
+    def batches(self, batch_size, action_size, epochs=None, prefetch=4):
+        """
+        Streams shuffled minibatches of the window without loading it: every
+        epoch draws a new random permutation of all the examples, like a
+        full shuffle, and reads the rows of each minibatch from the memory
+        maps. A background thread keeps up to prefetch minibatches ready.
+
+        Returns:
+            generator of (boards, [pis, vs]) minibatches for epochs epochs
+            (forever if epochs is None), pis densified to action_size
+        """
+        sizes = np.array([len(self.segment(name)['values']) for name in self.segments])
+        ready = queue.Queue(maxsize=prefetch)
+        stop = threading.Event()
+
+        def load():
+            epoch = 0
+            while epochs is None or epoch < epochs:
+                order = np.random.permutation(int(sizes.sum()))
+                for start in range(0, len(order), batch_size):
+                    boards, pis, vs = self.batch(order[start:start + batch_size], sizes, action_size)
+                    while not stop.is_set():
+                        try:
+                            ready.put((boards, [pis, vs]), timeout=0.1)
+                            break
+                        except queue.Full:
+                            pass
+                    if stop.is_set():
+                        return
+                epoch += 1
+            ready.put(None)
+
+        loader = threading.Thread(target=load)
+        loader.daemon = True
+        loader.start()
+        try:
+            while True:
+                batch = ready.get()
+                if batch is None:
+                    return
+                yield batch
+        finally:
+            stop.set()
+
+    def pendingFiles(self):
+        """
+        Returns:
+            paths: the files of the episodes added with appendEpisode() and
+                   not committed yet, oldest first
+        """
+        if not os.path.isdir(self.folder):
+            return []
+        names = [f for f in os.listdir(self.folder) if f.startswith('pending_') and f.endswith('.npz')]
+        return [os.path.join(self.folder, f) for f in sorted(names, key=lambda f: int(f[8:-4]))]
+
+    def appendEpisode(self, examples):
+        """
+        Persists the examples of one episode right away, so a crash in the
+        middle of an iteration keeps the episodes already played. An empty
+        episode is stored too, it still counts as played.
+        """
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+        pending = self.pendingFiles()
+        n = int(os.path.basename(pending[-1])[8:-4]) + 1 if pending else 0
+        path = os.path.join(self.folder, 'pending_' + str(n) + '.npz')
+        with open(path + '.tmp', 'wb') as f:
+            if examples:
+                np.savez(f, **self.toArrays(examples))
+            else:
+                np.savez(f)
+        os.replace(path + '.tmp', path)
+
+    def clearPending(self):
+        """
+        Deletes the pending episodes, e.g. left over by a run that is not
+        resumed.
+        """
+        for path in self.pendingFiles():
+            os.remove(path)
+
+    def pendingExamples(self):
+        """
+        Returns:
+            examples: list of (board, pi, v) of the pending episodes
+        """
+        examples = []
+        for path in self.pendingFiles():
+            with np.load(path) as seg:
+                if 'values' not in seg:
+                    continue
+                split = seg['indptr'][1:-1]
+                actions = np.split(seg['actions'], split)
+                probs = np.split(seg['probs'].astype(np.float32), split)
+                examples += zip(seg['boards'], zip(actions, probs), seg['values'])
+        return examples
+
+    def commitPending(self, tag, maxlen=None):
+        """
+        Moves the pending episodes into one new segment, keeping the last
+        maxlen examples, and deletes them. tag (the iteration) is recorded
+        with the segment, so committing the same tag twice after a crash
+        does not add its episodes twice.
+
+        Returns:
+            added: the number of examples stored in the new segment
+        """
+        added = 0
+        if self.committed != tag:
+            examples = self.pendingExamples()
+            if maxlen is not None:
+                examples = examples[-maxlen:]
+            self.committed = tag
+            if examples:
+                self.addSegment(self.toArrays(examples))
+            else:
+                self.saveManifest()
+            added = len(examples)
+        self.clearPending()
+        return added
@@ -0,0 +1,533 @@
+from MCTS import MCTS
+from EvalCache import EvalCache
+from ExampleRing import ExampleRing
+from NeuralNet import NeuralNet
+from chess.ChessGame import ChessGame
+from othello.OthelloGame import OthelloGame
+from utils import *
+
+import multiprocessing as mp
+import numpy as np
+import random, sys, time
+
+"""
+use this script to time the self-play machinery without a trained network.
+UniformNNet stands in for the keras nets so only the search itself is timed.
+
+    python benchmark.py mcts [numMCTSSims] [moves]
+    python benchmark.py batch [numMCTSSims] [moves]
+    python benchmark.py reuse [numMCTSSims] [moves]
+    python benchmark.py history [numMCTSSims] [moves]
+    python benchmark.py bounded [numMCTSSims] [moves] [maxNodes]
+    python benchmark.py widening [numMCTSSims] [moves] [topKMoves]
+    python benchmark.py ring [workers] [episodes] [examples]
+    python benchmark.py lockstep [numMCTSSims] [moves]
+    python benchmark.py nnetserver [workers] [requests]
+    python benchmark.py roundtrip [requests] [nnet_workers]
+    python benchmark.py scheduler [workers] [requests]
+    python benchmark.py transport [workers] [requests]
+    python benchmark.py hotswap [workers] [seconds]
+    python benchmark.py evalcache [entries]
+"""
+
+
+class UniformNNet(NeuralNet):
+    """
+    Returns a uniform policy and a value of 0 for every board.
+    """
+    def __init__(self, game):
+        self.action_size = game.getActionSize()
+        self.calls = 0
+
+    def predict(self, board):
+        self.calls += 1
+        return np.full(self.action_size, 1./self.action_size, dtype=np.float32), np.zeros(1, dtype=np.float32)
+
+    def predict_batch(self, boards):
+        self.calls += 1
+        return np.full((len(boards), self.action_size), 1./self.action_size, dtype=np.float32), np.zeros((len(boards), 1), dtype=np.float32)
+
+
+def play_moves(game, mcts, moves, reuse=False, sizes=None):
+    """
+    Plays up to moves moves of a single game with mcts choosing every move.
+    With reuse the tree is advanced to every new board and the size of the
+    NodeTable after each move is appended to sizes.
+    Returns the time taken by each getActionProb call.
+    """
+    times = []
+    board = game.getInitBoard()
+    curPlayer = 1
+    for _ in range(moves):
+        canonicalBoard = game.getCanonicalForm(board, curPlayer)
+        if reuse:
+            mcts.advanceRoot(canonicalBoard)
+        start = time.time()
+        pi = mcts.getActionProb(canonicalBoard, temp=1)
+        times.append(time.time() - start)
+        if sizes is not None:
+            sizes.append(len(mcts.nodes))
+
+        action = np.random.choice(len(pi), p=pi)
+        board, curPlayer = game.getNextState(board, curPlayer, action)
+        if game.getGameEnded(board, curPlayer) != 0:
+            break
+    return times
+
+
+def bench_mcts(sims=100, moves=10):
+    """
+    Compares the dict-backed MCTS with args.nodeTable on chess and Othello.
+    Most of the time goes to the game logic (move generation), which both
+    modes share, so they run at about the same speed.
+    """
+    for name, make_game in [("chess", ChessGame), ("othello", lambda: OthelloGame(8))]:
+        for node_table in [False, True]:
+            np.random.seed(0)
+            game = make_game()
+            args = dotdict({'numMCTSSims': sims, 'cpuct': 1.0, 'nodeTable': node_table})
+            mcts = MCTS(game, UniformNNet(game), args)
+            times = play_moves(game, mcts, moves)
+            print("{:8s} {:10s} sims={:4d} moves={:3d} | {:.4f}s/move {:.1f}sims/s".format(
+                  name, "nodeTable" if node_table else "dict", sims, len(times),
+                  np.mean(times), sims / np.mean(times)))
+
+
+def bench_batch(sims=100, moves=10):
+    """
+    Counts nnet calls per move with args.searchBatchSize on Othello.
+    """
+    for k in [1, 4, 8, 16]:
+        np.random.seed(0)
+        game = OthelloGame(8)
+        nnet = UniformNNet(game)
+        args = dotdict({'numMCTSSims': sims, 'cpuct': 1.0, 'nodeTable': True, 'searchBatchSize': k})
+        times = play_moves(game, MCTS(game, nnet, args), moves)
+        print("othello searchBatchSize={:3d} sims={:4d} | {:.1f} nnet calls/move {:.4f}s/move".format(
+              k, sims, nnet.calls / len(times), np.mean(times)))
+
+
+def bench_reuse(sims=100, moves=60):
+    """
+    Tracks the NodeTable size over a chess game with and without
+    advanceRoot() between moves.
+    """
+    for reuse in [False, True]:
+        np.random.seed(0)
+        game = ChessGame()
+        args = dotdict({'numMCTSSims': sims, 'cpuct': 1.0, 'nodeTable': True})
+        sizes = []
+        times = play_moves(game, MCTS(game, UniformNNet(game), args), moves, reuse=reuse, sizes=sizes)
+        print("chess reuse={:5s} sims={:4d} moves={:3d} | nodes max={:6d} last={:6d} {:.4f}s/move".format(
+              str(reuse), sims, len(times), max(sizes), sizes[-1], np.mean(times)))
+
+
+def bench_history(sims=25, moves=200):
+    """
+    Time per move over a long chess game, in buckets of 25 plies. The
+    repetition history of the game grows with every ply, the time per move
+    should not.
+    """
+    np.random.seed(0)
+    game = ChessGame()
+    args = dotdict({'numMCTSSims': sims, 'cpuct': 1.0, 'nodeTable': True})
+    times = play_moves(game, MCTS(game, UniformNNet(game), args), moves, reuse=True)
+    for start in range(0, len(times), 25):
+        bucket = times[start:start + 25]
+        print("chess plies {:3d}-{:3d} sims={:4d} | {:.4f}s/move".format(
+              start + 1, start + len(bucket), sims, np.mean(bucket)))
+
+
+def bench_bounded(sims=100, moves=40, max_nodes=1000):
+    """
+    Plays two Othello games with one MCTS and no advanceRoot(), once
+    unbounded and once capped to max_nodes, and reports the table counters.
+    """
+    for cap in [None, max_nodes]:
+        np.random.seed(0)
+        game = OthelloGame(8)
+        args = dotdict({'numMCTSSims': sims, 'cpuct': 1.0, 'nodeTable': True, 'maxNodes': cap})
+        mcts = MCTS(game, UniformNNet(game), args)
+        times = play_moves(game, mcts, moves) + play_moves(game, mcts, moves)
+        print("othello maxNodes={:6s} sims={:4d} moves={:3d} | {:.4f}s/move {}".format(
+              str(cap), sims, len(times), np.mean(times), mcts.nodes.stats()))
+
+
+def bench_widening(sims=200, moves=10, top_k=4):
+    """
+    Per-node memory of the priors and statistics on chess, for the dicts,
+    the NodeTable and the NodeTable with progressive widening.
+    """
+    for name, extra in [("dict", {}), ("nodeTable", {'nodeTable': True}), ("topKMoves=" + str(top_k), {'topKMoves': top_k})]:
+        np.random.seed(0)
+        game = ChessGame()
+        args = dotdict({'numMCTSSims': sims, 'cpuct': 1.0})
+        args.update(extra)
+        mcts = MCTS(game, UniformNNet(game), args)
+        times = play_moves(game, mcts, moves)
+        if mcts.nodeTable:
+            nodes = mcts.nodes.ids.values()
+            arrays = [mcts.nodes.actions, mcts.nodes.Ps, mcts.nodes.Nsa, mcts.nodes.Qsa, mcts.nodes.children]
+            size = sum(a[n].nbytes for n in nodes for a in arrays) / len(nodes)
+            visited = np.mean([np.count_nonzero(mcts.nodes.Nsa[n]) for n in nodes if mcts.nodes.Ns[n] > 0])
+        else:
+            size = sum(mcts.Ps[s].nbytes + mcts.As[s].nbytes for s in mcts.Ps) / len(mcts.Ps)
+            size += 2 * 8 * len(mcts.Nsa) / len(mcts.Ps)    # one Qsa and Nsa entry per edge
+            visited = len(mcts.Nsa) / sum(1 for s in mcts.Ns if mcts.Ns[s] > 0)
+        print("chess {:12s} sims={:4d} | {:6.0f} bytes/node {:4.1f} children/node {:.4f}s/move".format(
+              name, sims, size, visited, np.mean(times)))
+
+
+def bench_lockstep(sims=100, moves=10):
+    """
+    Steps n Othello games in lockstep, like Coach.lockstepWorker, and counts
+    the nnet calls and the boards per call.
+    """
+    for n in [1, 4, 16]:
+        np.random.seed(0)
+        games = [OthelloGame(8) for _ in range(n)]
+        nnet = UniformNNet(games[0])
+        args = dotdict({'numMCTSSims': sims, 'cpuct': 1.0, 'nodeTable': True, 'searchBatchSize': 8})
+        mctss = [MCTS(game, nnet, args) for game in games]
+        boards = [game.getInitBoard() for game in games]
+        players = [1] * n
+        evaluated = 0
+        start = time.time()
+        for _ in range(moves):
+            steps = [mcts.searchSteps(game.getCanonicalForm(board, player), temp=1)
+                     for mcts, game, board, player in zip(mctss, games, boards, players)]
+            requests = [next(step) for step in steps]
+            pis = [None] * n
+            while any(r is not None for r in requests):
+                batch = np.concatenate([r for r in requests if r is not None])
+                evaluated += len(batch)
+                ps, vs = nnet.predict_batch(batch)
+                offset = 0
+                for j, r in enumerate(requests):
+                    if r is None:
+                        continue
+                    try:
+                        requests[j] = steps[j].send((ps[offset:offset + len(r)], vs[offset:offset + len(r)]))
+                    except StopIteration as stop:
+                        requests[j], pis[j] = None, stop.value
+                    offset += len(r)
+            for j in range(n):
+                action = np.random.choice(len(pis[j]), p=pis[j])
+                boards[j], players[j] = games[j].getNextState(boards[j], players[j], action)
+        elapsed = time.time() - start
+        print("othello games={:3d} sims={:4d} moves={:3d} | {:.1f} nnet calls/move {:.1f} boards/call {:.4f}s/move".format(
+              n, sims, moves, nnet.calls / float(n * moves), evaluated / float(nnet.calls), elapsed / (n * moves)))
+
+
+class TimedNNet(UniformNNet):
+    """
+    UniformNNet with the cost profile of a forward pass: a fixed 2 ms per
+    call plus 0.05 ms per board.
+    """
+    def predict_batch(self, boards):
+        time.sleep(0.002 + 0.00005 * len(boards))
+        return UniformNNet.predict_batch(self, boards)
+
+
+def nnetserver_client(manager, game, requests):
+    board = game.getInitBoard()
+    for _ in range(requests):
+        manager.predict(board)
+
+
+def bench_nnetserver(workers=12, requests=200):
+    """
+    Throughput and latency of one NNetWorker serving workers processes
+    that call predict() one board at a time, for several max batch sizes.
+    """
+    from AtomicNeuralNet import NNetManager, NNetWorker
+    game = OthelloGame(8)
+    for max_batch in [1, 4, 16, 64]:
+        manager = NNetManager(1, True)
+        server = mp.Process(target=NNetWorker, args=(game, manager.nsync(0), 0, max_batch, 0.002, TimedNNet))
+        server.start()
+        clients = [mp.Process(target=nnetserver_client, args=(manager, game, requests)) for _ in range(workers)]
+        start = time.time()
+        for p in clients:
+            p.start()
+        for p in clients:
+            p.join()
+        elapsed = time.time() - start
+        stats = manager.stats()[0]
+        server.terminate()
+        print("nnet server workers={:3d} max_batch={:3d} | {:.0f} boards/sec {:.1f} boards/batch latency p50={:.1f}ms p90={:.1f}ms p99={:.1f}ms".format(
+              workers, max_batch, workers * requests / elapsed, stats["mean_batch"], stats["p50_ms"], stats["p90_ms"], stats["p99_ms"]))
+
+
+def roundtrip_client(manager, game, requests, results):
+    board = game.getInitBoard()
+    latencies = []
+    for _ in range(requests):
+        start = time.time()
+        manager.predict(board)
+        latencies.append(time.time() - start)
+    results.put(latencies)
+
+
+def bench_roundtrip(requests=200, nnet_workers=4):
+    """
+    Round trip latency of NNetManager.predict() with 1, 4, 12 and 32
+    processes calling it at once. UniformNNet answers instantly, so only
+    the dispatch to the NNetWorkers and back is timed.
+    """
+    from AtomicNeuralNet import NNetManager, NNetWorker
+    game = OthelloGame(8)
+    for clients in [1, 4, 12, 32]:
+        manager = NNetManager(nnet_workers, True)
+        servers = [mp.Process(target=NNetWorker, args=(game, manager.nsync(i), i, 1, 0, UniformNNet))
+                   for i in range(nnet_workers)]
+        for p in servers:
+            p.start()
+        results = mp.Queue()
+        procs = [mp.Process(target=roundtrip_client, args=(manager, game, requests, results)) for _ in range(clients)]
+        start = time.time()
+        for p in procs:
+            p.start()
+        latencies = np.concatenate([results.get() for _ in procs]) * 1000
+        elapsed = time.time() - start
+        for p in procs:
+            p.join()
+        for p in servers:
+            p.terminate()
+        print("predict round trip clients={:3d} nnet_workers={} | {:.0f} predicts/sec p50={:.2f}ms p90={:.2f}ms p99={:.2f}ms".format(
+              clients, nnet_workers, clients * requests / elapsed, np.percentile(latencies, 50),
+              np.percentile(latencies, 90), np.percentile(latencies, 99)))
+
+
+class SlowNNet(TimedNNet):
+    """
+    TimedNNet four times slower, e.g. a worker sharing its device with the
+    training.
+    """
+    def predict_batch(self, boards):
+        time.sleep(3 * (0.002 + 0.00005 * len(boards)))
+        return TimedNNet.predict_batch(self, boards)
+
+
+def bench_scheduler(workers=12, requests=200, nnet_workers=4):
+    """
+    Throughput, latency and the requests each NNetWorker got with workers
+    processes calling predict() one board at a time, when the first of
+    nnet_workers NNetWorkers is four times slower than the others.
+    """
+    from AtomicNeuralNet import NNetManager, NNetWorker
+    game = OthelloGame(8)
+    manager = NNetManager(nnet_workers, True)
+    servers = [mp.Process(target=NNetWorker, args=(game, manager.nsync(i), i, 16, 0.002, SlowNNet if i == 0 else TimedNNet))
+               for i in range(nnet_workers)]
+    for p in servers:
+        p.start()
+    results = mp.Queue()
+    procs = [mp.Process(target=roundtrip_client, args=(manager, game, requests, results)) for _ in range(workers)]
+    start = time.time()
+    for p in procs:
+        p.start()
+    latencies = np.concatenate([results.get() for _ in procs]) * 1000
+    elapsed = time.time() - start
+    for p in procs:
+        p.join()
+    stats = manager.stats()
+    for p in servers:
+        p.terminate()
+    print("scheduler workers={:3d} nnet_workers={} | {:.0f} predicts/sec p50={:.1f}ms p90={:.1f}ms p99={:.1f}ms".format(
+          workers, nnet_workers, workers * requests / elapsed, np.percentile(latencies, 50),
+          np.percentile(latencies, 90), np.percentile(latencies, 99)))
+    for i, summary in enumerate(stats):
+        print("  nnet worker {}{} | {:5d} requests {:.0%} busy {:.1f} boards/batch".format(
+              i, " (slow)" if i == 0 else "", summary["requests"], summary["busy"], summary["mean_batch"]))
+
+
+def bench_transport(workers=4, requests=200, repeats=2000):
+    """
+    Bytes pickled per chess predict and the time spent pickling and
+    unpickling them, with the boards, policies and values in the messages
+    and with them in PredictSlots, then the predict() throughput of
+    workers processes through 2 NNetWorkers with either transport.
+    """
+    import pickle
+    from AtomicNeuralNet import NNetManager, NNetWorker
+    game = ChessGame()
+    board = game.getInitBoard()
+    pi, v = UniformNNet(game).predict(board)
+    data_id = "%x" % random.getrandbits(256)
+    messages = {'pickled': [(data_id, 0, {"inst": "predict", "board": board, "sent": time.time(), "load": 1}), (data_id, (pi, v))],
+                'shared': [(data_id, 0, {"inst": "predict", "shared": 1, "sent": time.time(), "load": 1}), (data_id, None)]}
+    for transport, (request, response) in messages.items():
+        start = time.time()
+        for _ in range(repeats):
+            pickle.loads(pickle.dumps(request))
+            pickle.loads(pickle.dumps(response))
+        elapsed = time.time() - start
+        print("transport={:7s} | {:5d} request bytes {:5d} response bytes {:.1f}us pickling per predict".format(
+              transport, len(pickle.dumps(request)), len(pickle.dumps(response)), elapsed / repeats * 1e6))
+
+    for transport in messages:
+        manager = NNetManager(2, True, game=game if transport == 'shared' else None)
+        servers = [mp.Process(target=NNetWorker, args=(game, manager.nsync(i), i, 1, 0, UniformNNet)) for i in range(2)]
+        for p in servers:
+            p.start()
+        results = mp.Queue()
+        procs = [mp.Process(target=roundtrip_client, args=(manager, game, requests, results)) for _ in range(workers)]
+        start = time.time()
+        for p in procs:
+            p.start()
+        latencies = np.concatenate([results.get() for _ in procs]) * 1000
+        elapsed = time.time() - start
+        for p in procs:
+            p.join()
+        for p in servers:
+            p.terminate()
+        print("transport={:7s} workers={:3d} | {:.0f} chess predicts/sec p50={:.2f}ms p99={:.2f}ms".format(
+              transport, workers, workers * requests / elapsed, np.percentile(latencies, 50), np.percentile(latencies, 99)))
+
+
+class SlowLoadNNet(TimedNNet):
+    """
+    TimedNNet that takes a second to load a checkpoint.
+    """
+    def load_checkpoint(self, folder, filename):
+        time.sleep(1)
+
+
+def hotswap_client(manager, game, seconds, results):
+    board = game.getInitBoard()
+    latencies = []
+    versions = set()
+    end = time.time() + seconds
+    while time.time() < end:
+        start = time.time()
+        manager.predict(board)
+        latencies.append(time.time() - start)
+        versions.update(manager.versions())
+    results.put((latencies, versions))
+
+
+def bench_hotswap(workers=12, seconds=4, nnet_workers=2):
+    """
+    Latency of the predicts of workers processes while a new model is
+    rolled out to nnet_workers NNetWorkers that take a second to load it,
+    with the blocking NNetManager.load_checkpoint() and with the hot
+    NNetManager.swap().
+    """
+    from AtomicNeuralNet import NNetManager, NNetWorker
+    game = OthelloGame(8)
+    for method in ['load', 'swap']:
+        manager = NNetManager(nnet_workers, True, game=game)
+        servers = [mp.Process(target=NNetWorker, args=(game, manager.nsync(i), i, 16, 0.002, SlowLoadNNet))
+                   for i in range(nnet_workers)]
+        for p in servers:
+            p.start()
+        results = mp.Queue()
+        procs = [mp.Process(target=hotswap_client, args=(manager, game, seconds, results)) for _ in range(workers)]
+        for p in procs:
+            p.start()
+        time.sleep(1)
+        start = time.time()
+        if method == 'load':
+            manager.load_checkpoint()
+        else:
+            manager.swap(version=1)
+        rollout = time.time() - start
+        results = [results.get() for _ in procs]
+        for p in procs:
+            p.join()
+        for p in servers:
+            p.terminate()
+        latencies = np.concatenate([r[0] for r in results]) * 1000
+        versions = set().union(*[r[1] for r in results]) - {None}
+        print("rollout={:4s} workers={:3d} | rollout {:.2f}s | {:.0f} predicts/sec p50={:.1f}ms p99={:.1f}ms max={:.0f}ms | versions seen {}".format(
+              method, workers, rollout, len(latencies) / float(seconds), np.percentile(latencies, 50),
+              np.percentile(latencies, 99), latencies.max(), sorted(versions)))
+
+
+def ring_worker(game, ring, done_queue, episodes, examples):
+    np.random.seed()
+    boards = np.array([game.getInitBoard()] * examples)
+    vs = np.ones(examples, dtype=np.float32)
+    for _ in range(episodes):
+        pis = [(np.sort(np.random.choice(game.getActionSize(), 30, replace=False)).astype(np.int32),
+                np.full(30, 1./30, dtype=np.float32)) for _ in range(examples)]
+        episode = (boards, pis, vs)
+        done_queue.put(ring.write(*episode) if ring is not None else episode)
+
+
+def bench_ring(workers=12, episodes=20, examples=80):
+    """
+    Time the master spends receiving chess episodes from workers, through
+    the queue with and without an ExampleRing. The workers first finish
+    sending, so only the receiving side is timed.
+    """
+    game = ChessGame()
+    for use_ring in [False, True]:
+        ring = ExampleRing(game, workers * episodes * examples) if use_ring else None
+        done_queue = mp.Queue()
+        procs = [mp.Process(target=ring_worker, args=(game, ring, done_queue, episodes, examples)) for _ in range(workers)]
+        for p in procs:
+            p.start()
+        while done_queue.qsize() < workers * episodes:
+            time.sleep(0.1)
+        start = time.time()
+        for _ in range(workers * episodes):
+            episode = done_queue.get()
+            if ring is not None:
+                episode = ring.read(episode)
+        elapsed = time.time() - start
+        for p in procs:
+            p.join()
+        print("chess {:5s} workers={:3d} | master {:.0f} episodes/s {:.0f} examples/s".format(
+              "ring" if use_ring else "queue", workers, workers * episodes / elapsed,
+              workers * episodes * examples / elapsed))
+
+
+def bench_evalcache(entries=1000):
+    """
+    Times EvalCache put() and get() with the near-flat chess policies of an
+    untrained net and checks that get() returns the policy put() was given.
+    """
+    game = ChessGame()
+    board = game.getInitBoard()
+    boards = [board + i for i in range(entries)]
+    pis = np.random.dirichlet(np.full(game.getActionSize(), 100.), entries).astype(np.float32)
+    cache = EvalCache(game, 4 * entries)
+
+    start = time.time()
+    for b, pi in zip(boards, pis):
+        cache.put(b, cache.getVersion(), pi, 0.5)
+    put_time = time.time() - start
+    start = time.time()
+    cached = [cache.get(b) for b in boards]
+    get_time = time.time() - start
+
+    stored = [i for i, res in enumerate(cached) if res is not None]
+    error = max(np.abs(cached[i][0] - pis[i]).max() / pis[i].max() for i in stored)
+    valids = game.getValidMoves(board, 1)
+    legal = np.count_nonzero(cached[0][0][valids == 1]) if cached[0] is not None else 0
+    print("chess entries={:5d} | put {:.0f}/s get {:.0f}/s | {} stored, max relative error {:.1e}, {}/{} legal moves with a prior".format(
+          entries, entries / put_time, entries / get_time, len(stored), error, legal, int(valids.sum())))
+    assert error < 1e-3, "get() does not return the policy given to put()"
+
+
+if __name__ == "__main__":
+    benches = {
+        'mcts': bench_mcts,
+        'batch': bench_batch,
+        'reuse': bench_reuse,
+        'history': bench_history,
+        'bounded': bench_bounded,
+        'widening': bench_widening,
+        'ring': bench_ring,
+        'lockstep': bench_lockstep,
+        'nnetserver': bench_nnetserver,
+        'roundtrip': bench_roundtrip,
+        'scheduler': bench_scheduler,
+        'transport': bench_transport,
+        'hotswap': bench_hotswap,
+        'evalcache': bench_evalcache,
+    }
+    bench = sys.argv[1] if len(sys.argv) > 1 else 'mcts'
+    benches[bench](*[int(x) for x in sys.argv[2:]])
@@ -14,11 +14,13 @@ class ChessGame(Game):
     def __init__(self):
         self.n = 8
         self.state_counts = defaultdict(int)
+        self.state_history = []     # boards counted in state_counts, in the order they were reached
 
     def getInitBoard(self):
         # return initial board (numpy board)
         game = Board()
         self.state_counts = defaultdict(int)
+        self.state_history = []
         return np.array(game.get_board_mcts())
 
     def getBoardSize(self):
@@ -46,7 +48,7 @@ class ChessGame(Game):
             no_move_board = copy.deepcopy(next_board)
             no_move_board[8,6] = 0
             no_move_board[8,7] = 0
-            self.state_counts[self.stringRepresentation(no_move_board)] += 1
+            self.pushState(no_move_board)
             return (next_board, -player)
 
         elif action < self.getActionSize() - 64*4 - 1:
@@ -65,7 +67,7 @@ class ChessGame(Game):
             no_move_board = copy.deepcopy(next_board)
             no_move_board[8,6] = 0
             no_move_board[8,7] = 0
-            self.state_counts[self.stringRepresentation(no_move_board)] += 1
+            self.pushState(no_move_board)
             return (next_board, -player)
 
         else:
@@ -91,7 +93,7 @@ class ChessGame(Game):
             no_move_board = copy.deepcopy(next_board)
             no_move_board[8,6] = 0
             no_move_board[8,7] = 0
-            self.state_counts[self.stringRepresentation(no_move_board)] += 1
+            self.pushState(no_move_board)
             return (next_board, -player)
 
     def getValidMoves(self, board, player):
@@ -141,7 +143,7 @@ class ChessGame(Game):
         if b.turn == WHITE and b.in_checkmate():
             return -1
 
-        if b.in_stalemate() or b.insufficient_material() or b.half_moves >= 50 or self.state_counts[str_rep_no_move] >= 3:
+        if b.in_stalemate() or b.insufficient_material() or b.half_moves >= 50 or self.state_counts.get(str_rep_no_move, 0) >= 3:
             return 1e-2
 
         #b.turn = swap_color(b.turn)
@@ -169,6 +171,23 @@ class ChessGame(Game):
         new_board[8,7] = 0
         return new_board.tostring()
 
+    def pushState(self, board):
+        # count board towards threefold repetition
+        s = self.stringRepresentation(board)
+        self.state_counts[s] += 1
+        self.state_history.append(s)
+
+    def getHistoryMark(self):
+        return len(self.state_history)
+
+    def rollbackHistory(self, mark):
+        # undo every pushState() since getHistoryMark() returned mark
+        while len(self.state_history) > mark:
+            s = self.state_history.pop()
+            self.state_counts[s] -= 1
+            if self.state_counts[s] == 0:
+                del self.state_counts[s]
+
     def getScore(self, board, player):
         #b = Board(mcts_board=board)
         return evaluate_board(board, player)
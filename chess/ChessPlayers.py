@@ -17,10 +17,28 @@ import os
 from utils import *
 from MCTS import MCTS
 
+def searchBudget(args):
+    """
+    Search limits of an NNet player: 'moveTime' is the number of seconds
+    per move and 'nodeBudget' the number of nodes per move. Either one
+    replaces 'numMCTSSims' (unless 'numMCTSSims' is also given, then the
+    first limit reached ends the search).
+    """
+    budget = dict()
+    if "moveTime" in args:
+        budget["deadline"] = time.time() + args["moveTime"]
+    if "nodeBudget" in args:
+        budget["nodes"] = args["nodeBudget"]
+    if budget and "numMCTSSims" in args:
+        budget["sims"] = args["numMCTSSims"]
+    return budget
+
+
 class NNetPlayer():
     def __init__(self, game, ckpt_path, ckpt_file, args):
         self.nnet = NNet(game)
-        self.args = dotdict(args)
+        # the NodeTable keeps the subtree of the move played, see MCTS.advanceRoot
+        self.args = dotdict(dict({'nodeTable': True}, **args))
 
         self.nnet.load_checkpoint(ckpt_path, ckpt_file)
 
@@ -28,7 +46,8 @@ class NNetPlayer():
 
     def play(self, board):
         tmp = self.args["temp"] if "temp" in self.args else 0
-        move = np.argmax(self.mcts.getActionProb(board, temp=tmp))
+        self.mcts.advanceRoot(board)
+        move = np.argmax(self.mcts.getActionProb(board, temp=tmp, **searchBudget(self.args)))
         return move
 
 
@@ -36,7 +55,8 @@ class NNetNetworkPlayer():
     def __init__(self, game, ckpt_path, ckpt_file, args):
         self.queue = Queue(maxsize=1)
         self.nnet = NNet(game)
-        self.args = dotdict(args)
+        # the NodeTable keeps the subtree of the move played, see MCTS.advanceRoot
+        self.args = dotdict(dict({'nodeTable': True}, **args))
 
         self.nnet.load_checkpoint(ckpt_path, ckpt_file)
 
@@ -44,7 +64,9 @@ class NNetNetworkPlayer():
 
     def play(self, board):
         tmp = self.args["temp"] if "temp" in self.args else 0
-        action = np.argmax(self.mcts.getActionProb(board, temp=tmp))
+        self.mcts.advanceRoot(board)
+        action = np.argmax(self.mcts.getActionProb(board, temp=tmp, **searchBudget(self.args)))
+        print("SEARCH STATS: " + str(self.mcts.searchStats))
 
         move = decode_move(action)
 
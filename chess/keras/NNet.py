@@ -9,6 +9,7 @@ import sys
 sys.path.append('..')
 from utils import *
 from NeuralNet import NeuralNet
+from ReplayBuffer import ReplayBuffer
 
 import argparse
 from .ChessNNet import ChessNNet as chessnet
@@ -32,13 +33,33 @@ class NNetWrapper(NeuralNet):
 
     def train(self, examples):
         """
-        examples: list of examples, each example is of form (board, pi, v)
+        examples: list of examples, each example is of form (board, pi, v),
+                  pi either dense or a sparse (actions, probs) pair. Can
+                  also be a ReplayBuffer, whose examples are then streamed
+                  from disk instead of loaded.
         """
-        input_boards, target_pis, target_vs = list(zip(*examples))
-        input_boards = np.asarray(input_boards)
-        target_pis = np.asarray(target_pis)
-        target_vs = np.asarray(target_vs)
-        self.nnet.model.fit(x = input_boards, y = [target_pis, target_vs], batch_size = args.batch_size, epochs = args.epochs)
+        if isinstance(examples, ReplayBuffer):
+            batches = examples.batches(args.batch_size, self.action_size, epochs = args.epochs)
+            steps = examples.steps(args.batch_size)
+        else:
+            input_boards, target_pis, target_vs = list(zip(*examples))
+            input_boards = np.asarray(input_boards)
+            target_vs = np.asarray(target_vs)
+
+            # The policies only get densified one batch at a time
+            def generate():
+                while True:
+                    order = np.random.permutation(len(examples))
+                    for start in range(0, len(examples), args.batch_size):
+                        idx = order[start:start + args.batch_size]
+                        pis = dense_policies([target_pis[j] for j in idx], self.action_size)
+                        yield input_boards[idx], [pis, target_vs[idx]]
+
+            batches = generate()
+            steps = int(math.ceil(len(examples) / float(args.batch_size)))
+
+        with self.nnet.graph.as_default():
+            self.nnet.model.fit_generator(batches, steps_per_epoch = steps, epochs = args.epochs)
 
     def predict(self, board):
         """
@@ -57,6 +78,14 @@ class NNetWrapper(NeuralNet):
             #print('PREDICTION TIME TAKEN : {0:03f}'.format(time.time()-start))
             return pi[0], v[0]
 
+    def predict_batch(self, boards):
+        """
+        boards: np array of boards stacked along the first axis
+        """
+        with self.nnet.graph.as_default():
+            pi, v = self.nnet.model.predict(boards, batch_size=len(boards))
+            return pi, v
+
     def save_checkpoint(self, folder='checkpoint', filename='checkpoint.pth.tar'):
         filepath = os.path.join(folder, filename)
         if not os.path.exists(folder):
@@ -64,7 +93,10 @@ class NNetWrapper(NeuralNet):
             os.mkdir(folder)
         else:
             print("Checkpoint Directory exists! ")
-        self.nnet.model.save_weights(filepath)
+        # Write next to the checkpoint and rename, so a crash never leaves a half written one
+        tmppath = os.path.join(folder, 'tmp_' + filename)
+        self.nnet.model.save_weights(tmppath)
+        os.replace(tmppath, filepath)
 
     def load_checkpoint(self, folder='checkpoint', filename='checkpoint.pth.tar'):
         # https://github.com/pytorch/examples/blob/master/imagenet/main.py#L98
@@ -5,6 +5,7 @@ from chess.keras.NNet import NNetWrapper as nn
 #from othello.keras.NNet import NNetWrapper as nn
 
 from AtomicNeuralNet import *
+from EvalCache import EvalCache
 from utils import *
 
 import multiprocessing as mp
@@ -12,21 +13,44 @@ import multiprocessing as mp
 args = dotdict({
     'numIters': 50,             # Total number of iterations of self-play, training, and evaluation
     'numEps': 100,              # Number of self-play examples generated per iteration
+    'samplesPerIter': 0,        # If > 0, self-play ends once this many examples are in and cancels the unfinished games, instead of playing numEps games
+    'samplesMaxEps': 400,       # With samplesPerIter, self-play also ends after this many games, in case the target is never reached
     'tempThreshold': 50,        # Number of stochastic MCTS simulations per training game
     'updateThreshold': 0.5,     # Percent minimum number of wins during evaluation to accept new model
     'maxlenOfQueue': 200000,    # Max number of examples in training data
     'numMCTSSims': 500,         # Number of MCTS simulations per move
+    'numMCTSSimsFast': 100,     # Number of MCTS simulations of the cheap searches of playout cap randomization
+    'playoutCapProb': 1,        # Fraction of self-play moves that get a full search and become training examples, e.g. 0.25 for playout cap randomization
+    'dirichletAlpha': None,     # Dirichlet noise added to the root priors of full self-play searches, e.g. 0.3 (chess), None for no noise
+    'dirichletEpsilon': 0.25,   # Weight of the root noise
     'arenaCompare': 20,         # Number of games in evaluation step
     'cpuct': 1,                 # MCTS exploration vs exploitation parameter
+    'nodeTable': False,         # Keep MCTS statistics in the array-backed NodeTable instead of dicts (less memory, same speed); batched, bounded and widened search always use it
+    'searchBatchSize': 8,       # Number of MCTS leaves evaluated per nnet call (virtual loss batching)
+    'maxNodeBytes': 128 * 2**20,# Memory cap of the MCTS NodeTable of each self-play worker
     'filter_draw_rate': 0,
 
     'mcts_workers': 12,
+    'lockstepGames': 1,         # Episodes each worker plays at once, their leaves batched into one nnet call (needs searchBatchSize > 1)
     'nnet_workers': 4,
+    'nnetMaxBatch': 64,         # Max boards an NNetWorker collects into one forward pass
+    'nnetBatchTimeout': 0.002,  # Seconds an NNetWorker waits for more boards before running a batch
+    'nnetSharedSlots': True,    # Pass the boards, policies and values of predict requests through shared memory instead of pickling them
+    'nnetHotSwap': True,        # Keep a standby model in every NNetWorker so new models are loaded without pausing self-play (twice the memory)
+    'evalCacheSize': 0,         # Number of nnet evaluations shared between workers (about 9 KB each for chess), e.g. 10000; 0 to disable
+    'exampleRingSize': 20000,   # Shared slots for the examples sent by the workers, 0 to send them through the queue
+    'brokerAddress': None,      # (host, port) or socket path to serve self-play to selfplay-worker.py on other machines
+    'brokerAuthkey': None,      # Secret shared with the workers, required on TCP; or set BROKER_AUTHKEY / BROKER_AUTHKEY_FILE
 
     'checkpoint': './temp/',
     'load_model': False,
     'load_folder_file': ('saves/','best.pth.tar'),
-    'numItersForTrainExamplesHistory': 20
+    'resume': False,            # Restart a crashed run in checkpoint at the iteration, stage and episode it stopped
+    'numItersForTrainExamplesHistory': 20,
+
+    'asyncPipeline': False,     # Run self-play, training and gating at the same time (Coach.learnAsync)
+    'asyncTrainSamples': 20000, # New self-play examples between two trainings in the async pipeline
+    'asyncReportSecs': 60,      # Seconds between two throughput reports of the async pipeline
 })
 
 def main():
@@ -39,20 +63,29 @@ def main():
 
     g = Game()
 
-    nnet = NNetManager(args.nnet_workers, os_supported)
+    cache = EvalCache(g, args.evalCacheSize) if args.evalCacheSize > 0 else None
+    nnet = NNetManager(args.nnet_workers, os_supported, cache=cache, game=g if args.nnetSharedSlots else None,
+                       slot_boards=args.searchBatchSize * args.lockstepGames)
     for i in range(args.nnet_workers):
-        mp.Process(target=NNetWorker, args=(g, nnet.nsync(i), i)).start()
+        mp.Process(target=NNetWorker, args=(g, nnet.nsync(i), i, args.nnetMaxBatch, args.nnetBatchTimeout),
+                   kwargs={'double_buffer': args.nnetHotSwap}).start()
 
     if args.load_model:
         nnet.load_checkpoint(args.load_folder_file[0], args.load_folder_file[1])
 
     c = Coach(g, nnet, args)
 
+    if args.resume:
+        c.loadState()
+
     if args.load_model:
         print("Load trainExamples from file")
         c.loadTrainExamples()
 
-    c.learn()
+    if args.asyncPipeline:
+        c.learnAsync()
+    else:
+        c.learn()
 
 if __name__=="__main__":
     main()
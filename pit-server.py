@@ -18,7 +18,7 @@ any agent.
 
 ncp_new = "saves/"                                         # Checkpoint path
 ncf_new = "checkpoint_2.pth.tar"                           # Checkpoint file
-nca_new = { 'numMCTSSims': 500, 'cpuct': 1.0, 'temp': 0 }  # NNet args
+nca_new = { 'moveTime': 5.0, 'cpuct': 1.0, 'temp': 0 }     # NNet args, 5 seconds per move
 
 #ncp_new = "saves/"                                         # Checkpoint path
 #ncf_new = "checkpoint_2.pth.tar"                           # Checkpoint file
@@ -0,0 +1,42 @@
+from Broker import broker_authkey
+from Coach import Coach
+from chess.ChessGame import ChessGame as Game
+from chess.keras.NNet import NNetWrapper as nn
+from main import args
+
+import multiprocessing as mp
+import sys
+
+"""
+use this script to add the cores of another machine to the self-play of a
+run started by main.py with args.brokerAddress set. Workers can be started
+and stopped at any time, the episodes they were playing go to other workers.
+The authkey of the broker is read from args.brokerAuthkey or the
+BROKER_AUTHKEY / BROKER_AUTHKEY_FILE environment variables.
+
+    python selfplay-worker.py host port [workers]
+    python selfplay-worker.py /path/to/socket [workers]
+"""
+
+
+def worker(address):
+    args.exampleRingSize = 0
+    g = Game()
+    c = Coach(g, nn(g), args, selfPlayOnly=True)
+    c.remoteWorker(address, broker_authkey(args.brokerAuthkey))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2 and sys.argv[2].isdigit() and not sys.argv[1].startswith('/'):
+        address = (sys.argv[1], int(sys.argv[2]))
+        rest = sys.argv[3:]
+    else:
+        address = sys.argv[1]
+        rest = sys.argv[2:]
+    workers = int(rest[0]) if rest else mp.cpu_count()
+
+    procs = [mp.Process(target=worker, args=(address,)) for _ in range(workers)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
@@ -1,3 +1,5 @@
+import numpy as np
+
 class dotdict(dict):
     def __getattr__(self, name):
         try:
@@ -24,6 +26,33 @@ class ParallelRuntimes():
         return self.avg() * (total - completed) / self.max_len
 
 
+def sparse_policy(pi):
+    """
+    Returns:
+        (actions, probs): int32 indices of the non-zero entries of the dense
+                          policy pi and their float32 probabilities
+    """
+    pi = np.asarray(pi, dtype=np.float32)
+    actions = np.flatnonzero(pi).astype(np.int32)
+    return actions, pi[actions]
+
+
+def dense_policies(pis, action_size):
+    """
+    Returns:
+        pis: float32 array of shape (len(pis), action_size) with the sparse
+             (actions, probs) policies of pis scattered back. Dense policies
+             are copied as they are.
+    """
+    dense = np.zeros((len(pis), action_size), dtype=np.float32)
+    for j, pi in enumerate(pis):
+        if isinstance(pi, tuple):
+            dense[j, pi[0]] = pi[1]
+        else:
+            dense[j] = pi
+    return dense
+
+
 def check_platform():
     from sys import platform
 